@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <Sponge - Lightweight Web Framework>
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+# Copyright (C) 2009 Bernardo Heynemann <heynemann@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Measures the image pipeline of sponge.helpers.image and
+sponge.contrib.controllers.ImageHandler with generated JPEG and PNG
+images of a few sizes, for each of these steps:
+
+ * decode: Image.open and load the whole image.
+ * crop: crop_to_fit to a 200x150 thumbnail, decoding included.
+ * resize: resize an already decoded image to a quarter of its size.
+ * encode-<profile>: encode an already decoded image with the
+   original, web and png profiles.
+ * picture: picture() to a 200x150 thumbnail, as a request would.
+ * handler-miss: ImageHandler rendering and caching a variant.
+ * handler-disk: ImageHandler sending a variant from its disk cache.
+ * handler-memory: ImageHandler sending a variant from memory.
+
+Each step runs in its own process, so that the "peak MB" column is the
+peak resident set size of that step alone, and "growth MB" how much it
+grew while the step was prepared and ran.
+
+The results can be saved with --json, and compared with a previous run
+with --compare, which shows how much each step got faster or slower.
+
+Usage: python benchmarks/image_pipeline.py [-n RUNS] [--steps STEPS]
+       [--json FILE] [--compare FILE]'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import optparse
+import traceback
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Image
+import ImageDraw
+import cherrypy
+from sponge.helpers import image
+from sponge.contrib.controllers import ImageHandler
+
+# name, width, height
+SIZES = [
+    ('small', 640, 480),
+    ('medium', 2048, 1536),
+    ('large', 4000, 3000),
+]
+
+FORMATS = [('JPEG', 'jpg'), ('PNG', 'png')]
+
+STEPS = ['decode', 'crop', 'resize', 'encode-original', 'encode-web',
+         'encode-png', 'picture', 'handler-miss', 'handler-disk',
+         'handler-memory']
+
+THUMBNAIL = (200, 150)
+
+COLUMNS = ['ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB', 'growth MB']
+
+def write_images(path):
+    '''Draws an image for each size and format, with gradients and
+    lines so that they compress like photos more than like blank
+    images.'''
+    names = []
+    for size_name, width, height in SIZES:
+        img = Image.new('RGB', (width, height))
+        draw = ImageDraw.Draw(img)
+        for y in range(0, height, 4):
+            shade = y * 255 / height
+            draw.rectangle((0, y, width, y + 3), fill=(shade, 128, 255 - shade))
+        for x in range(0, width, 23):
+            draw.line((x, 0, width - x, height), fill=(x % 255, 40, 90))
+
+        for format, extension in FORMATS:
+            name = '%s.%s' % (size_name, extension)
+            img.save(os.path.join(path, name), format, quality=90)
+            names.append(name)
+
+    return names
+
+def megabytes(maxrss):
+    # ru_maxrss is in kilobytes on Linux, but in bytes on Mac OS X
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def consume(body):
+    if isinstance(body, basestring):
+        return len(body)
+    return sum([len(chunk) for chunk in body])
+
+def prepare(step, name, image_dir, cache_dir):
+    '''Returns the function that runs the given step once.'''
+    fullpath = os.path.join(image_dir, name)
+    width, height = THUMBNAIL
+
+    if step == 'decode':
+        return lambda: Image.open(fullpath).load()
+
+    if step == 'crop':
+        return lambda: image.crop_to_fit(Image.open(fullpath), THUMBNAIL)
+
+    if step == 'resize':
+        img = Image.open(fullpath)
+        img.load()
+        size = (img.size[0] / 4, img.size[1] / 4)
+        return lambda: img.resize(size, Image.ANTIALIAS)
+
+    if step.startswith('encode-'):
+        img = Image.open(fullpath)
+        img.load()
+        profile = image.profiles[step.split('-', 1)[1]]
+        return lambda: image.encode(img, profile)
+
+    if step == 'picture':
+        return lambda: image.picture(name, width, height)
+
+    args = ('crop', '%dx%d' % THUMBNAIL, name)
+    if step == 'handler-miss':
+        handler = ImageHandler(cache_at=cache_dir)
+        cached = handler.get_cache_path('/'.join(args))
+
+        def run():
+            if os.path.exists(cached):
+                os.remove(cached)
+            return consume(handler(*args))
+        return run
+
+    if step == 'handler-disk':
+        handler = ImageHandler(cache_at=cache_dir)
+    else:
+        handler = ImageHandler(memory_cache_size=64 * 1024 * 1024)
+
+    consume(handler(*args))
+    return lambda: consume(handler(*args))
+
+def measure(step, name, image_dir, cache_dir, runs, results):
+    cherrypy.config['image.dir'] = image_dir
+    cherrypy.request.base = 'http://localhost:8080'
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run = prepare(step, name, image_dir, cache_dir)
+    run()
+
+    timings = []
+    started = time.time()
+    for i in range(runs):
+        cherrypy.response.headers.clear()
+        cherrypy.response.status = 200
+        if hasattr(cherrypy.response, 'ETag'):
+            del cherrypy.response.ETag
+
+        began = time.time()
+        run()
+        timings.append(time.time() - began)
+
+    elapsed = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    results.put({
+        'ops/s': runs / elapsed,
+        'p50 ms': percentile(timings, 50) * 1000,
+        'p90 ms': percentile(timings, 90) * 1000,
+        'p99 ms': percentile(timings, 99) * 1000,
+        'peak MB': megabytes(peak),
+        'growth MB': megabytes(peak - before),
+    })
+
+def measure_or_fail(step, name, image_dir, cache_dir, runs, results):
+    # the parent waits for a result, so it gets one even on errors
+    try:
+        measure(step, name, image_dir, cache_dir, runs, results)
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+def run_isolated(step, name, image_dir, cache_dir, runs):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_or_fail,
+                                      args=(step, name, image_dir,
+                                            cache_dir, runs, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def compare(previous, key, column, value):
+    old = previous.get(key, {}).get(column)
+    if not old:
+        return ''
+
+    # for the timings, lower is better
+    change = (value - old) / old * 100
+    if column != 'ops/s':
+        change = -change
+
+    return '%+.0f%%' % change
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('-n', '--runs', type='int', default=20,
+                      help='how many times to run each step for each '
+                      'image, defaults to 20')
+    parser.add_option('--steps', default=','.join(STEPS),
+                      help='comma separated steps to run, defaults to '
+                      'all of them')
+    parser.add_option('--json', dest='json_path',
+                      help='saves the results to the given file')
+    parser.add_option('--compare', dest='compare_path',
+                      help='compares the results to the ones saved '
+                      'in the given file')
+    options, args = parser.parse_args()
+
+    steps = [s for s in options.steps.split(',') if s]
+    unknown = [s for s in steps if s not in STEPS]
+    if unknown:
+        parser.error('unknown steps: %s' % ', '.join(unknown))
+
+    previous = {}
+    if options.compare_path:
+        previous = json.load(open(options.compare_path))['results']
+
+    image_dir = tempfile.mkdtemp(prefix='sponge-bench-images-')
+    cache_dir = tempfile.mkdtemp(prefix='sponge-bench-cache-')
+    results = {}
+    try:
+        names = write_images(image_dir)
+
+        sys.stdout.write('%-16s %-12s' % ('step', 'image'))
+        sys.stdout.write(''.join(['%11s' % c for c in COLUMNS]))
+        if previous:
+            sys.stdout.write('%11s%11s' % ('ops/s vs', 'p50 vs'))
+        sys.stdout.write('\n')
+
+        for step in steps:
+            for name in names:
+                result = run_isolated(step, name, image_dir, cache_dir,
+                                      options.runs)
+                sys.stdout.write('%-16s %-12s' % (step, name))
+                if 'error' in result:
+                    sys.stdout.write(' failed:\n%s' % result['error'])
+                    continue
+
+                key = '%s %s' % (step, name)
+                results[key] = result
+                for column in COLUMNS:
+                    sys.stdout.write('%11.2f' % result[column])
+                if previous:
+                    for column in ('ops/s', 'p50 ms'):
+                        sys.stdout.write('%11s' % compare(previous, key, column,
+                                                          result[column]))
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(image_dir)
+        shutil.rmtree(cache_dir)
+
+    if options.json_path:
+        output = open(options.json_path, 'w')
+        json.dump({
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'pil': getattr(Image, 'VERSION', None),
+            'platform': platform.platform(),
+            'runs': options.runs,
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+        output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <Sponge - Lightweight Web Framework>
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+# Copyright (C) 2009 Bernardo Heynemann <heynemann@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Measures sponge.template.render_html with a few generated templates
+of different sizes and include depths, for three modes:
+
+ * cold: the loaders are cleared before each render, so every render
+   parses the templates, like Sponge used to do on every request.
+ * warm: the compiled templates are reused.
+ * cached: the output cache is used, so the template runs only once.
+
+Each template and mode runs in its own process, so that the "peak MB"
+column is the peak resident set size of that run alone, and "growth MB"
+how much it grew while the template was loaded and rendered.
+
+Usage: python benchmarks/template_rendering.py [-n RENDERS]'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import traceback
+import resource
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cherrypy
+from sponge import template
+
+PAGE = '''<html xmlns="http://www.w3.org/1999/xhtml"
+      xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <head><title>${title}</title></head>
+  <body>
+    %(include)s
+    <table>
+      <tr py:for="row in rows">
+        <td>${row}</td><td><a href="${make_url('/item/%%s' %% row)}">item ${row}</a></td>
+      </tr>
+    </table>
+  </body>
+</html>
+'''
+
+PARTIAL = '''<div xmlns:py="http://genshi.edgewall.org/"
+     xmlns:xi="http://www.w3.org/2001/XInclude">
+  <p py:for="i in range(10)">partial %(depth)d, line ${i}</p>
+  %(include)s
+</div>
+'''
+
+INCLUDE = '<xi:include href="%s" />'
+
+# name, number of table rows, include depth
+TEMPLATES = [
+    ('small.html', 10, 0),
+    ('medium.html', 200, 1),
+    ('large.html', 2000, 0),
+    ('nested.html', 200, 4),
+]
+
+MODES = ['cold', 'warm', 'cached']
+
+def write_templates(path):
+    for name, rows, depth in TEMPLATES:
+        prefix = os.path.splitext(name)[0]
+        for level in range(depth, 0, -1):
+            include = ''
+            if level < depth:
+                include = INCLUDE % ('%s_partial%d.html' % (prefix, level + 1))
+
+            partial = open(os.path.join(path, '%s_partial%d.html' % (prefix, level)), 'w')
+            partial.write(PARTIAL % {'depth': level, 'include': include})
+            partial.close()
+
+        include = ''
+        if depth:
+            include = INCLUDE % ('%s_partial1.html' % prefix)
+
+        page = open(os.path.join(path, name), 'w')
+        page.write(PAGE % {'include': include})
+        page.close()
+
+def megabytes(maxrss):
+    # ru_maxrss is in kilobytes on Linux, but in bytes on Mac OS X
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def render(name, rows, mode, path):
+    context = {'title': 'benchmark', 'rows': range(rows)}
+    if mode == 'cold':
+        template.clear_loaders()
+        return template.render_html(name, context, template_path=path)
+
+    if mode == 'cached':
+        return template.render_html(name, context, template_path=path,
+                                    cache_key=lambda context: 'bench')
+
+    return template.render_html(name, context, template_path=path)
+
+def measure(name, rows, mode, path, renders, results):
+    cherrypy.request.base = 'http://localhost:8080'
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    render(name, rows, mode, path)
+
+    timings = []
+    started = time.time()
+    for i in range(renders):
+        before = time.time()
+        render(name, rows, mode, path)
+        timings.append(time.time() - before)
+
+    elapsed = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    results.put({
+        'renders/s': renders / elapsed,
+        'p50 ms': percentile(timings, 50) * 1000,
+        'p90 ms': percentile(timings, 90) * 1000,
+        'p99 ms': percentile(timings, 99) * 1000,
+        'peak MB': megabytes(peak),
+        'growth MB': megabytes(peak - maxrss),
+    })
+
+def measure_or_fail(name, rows, mode, path, renders, results):
+    # the parent waits for a result, so it gets one even on errors
+    try:
+        measure(name, rows, mode, path, renders, results)
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+
+def run_isolated(name, rows, mode, path, renders):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_or_fail,
+                                      args=(name, rows, mode, path,
+                                            renders, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('-n', '--renders', type='int', default=200,
+                      help='how many renders to measure for each '
+                      'template and mode, defaults to 200')
+    options, args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='sponge-bench-')
+    try:
+        write_templates(path)
+        columns = ['renders/s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB',
+                   'growth MB']
+        sys.stdout.write('%-12s %-7s' % ('template', 'mode'))
+        sys.stdout.write(''.join(['%14s' % c for c in columns]) + '\n')
+
+        for name, rows, depth in TEMPLATES:
+            for mode in MODES:
+                results = run_isolated(name, rows, mode, path,
+                                       options.renders)
+                sys.stdout.write('%-12s %-7s' % (name, mode))
+                if 'error' in results:
+                    sys.stdout.write(' failed:\n%s' % results['error'])
+                    continue
+
+                for column in columns:
+                    sys.stdout.write('%14.2f' % results[column])
+                sys.stdout.write('\n')
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
@@ -20,5 +20,5 @@
 __version__ = '0.3.1'
 
 from sponge.controller import Controller, route
-from sponge.template import render_html
+from sponge.template import render_html, stream_html
 
@@ -17,16 +17,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
 import sys
 import yaml
 import cherrypy
 import optparse
+import multiprocessing
 
 from sponge import __version__ as version
 from sponge.core import ConfigValidator, SpongeConfig
 from sponge.core.io import FileSystem
 from sponge.data import SpongeData
+from sponge.contrib.controllers import ImageHandler, parse_size
+from sponge.helpers.image import render_picture, profiles, \
+     get_profile_name, IMAGE_EXTENSIONS
 
 basic_config = {
     'run-as': 'wsgi',
@@ -55,6 +60,7 @@ class Bob(object):
         ('create', '<projectname> - creates a new project, which means creating a new folder in current directory, named projectname'),
         ('go', 'start the cherrypy server using the configuration file settings.yml in current directory.'),
         ('start', '<projectname> executes both bob create and bob go'),
+        ('warm', '<cachepath> [<width>x<height> ...] renders into cachepath the images cropped to the given sizes, or to the image-sizes setting, skipping the ones already there.'),
     ]
 
     def __init__(self, parser=None, fs=None):
@@ -169,6 +175,115 @@ class Bob(object):
     def get_file_path(self):
         return __file__
 
+    def get_warm_jobs(self, handler, sizes):
+        '''Returns (source, width, height, profile, target, version) for
+        each image within image.dir and each size which is not cached
+        yet, and how many are already cached.'''
+        image_dir = cherrypy.config['image.dir']
+        profile = get_profile_name()
+
+        jobs = []
+        cached = 0
+        for source in sorted(self.fs.locate(image_dir, '*')):
+            if os.path.splitext(source)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+
+            path = os.path.relpath(source, image_dir)
+            version = handler.get_version(path)
+            for width, height in sizes:
+                key = handler.get_key('crop/%dx%d/%s' % (width, height, path),
+                                      profile)
+                target = handler.get_cache_path(key)
+
+                # the cache files are renamed into place once complete,
+                # so an interrupted run can be resumed from where it was,
+                # the ones rendered from another version of their source
+                # are rendered again
+                if self.fs.exists(target) and \
+                       handler.is_fresh(target, version):
+                    cached += 1
+                    continue
+
+                jobs.append((source, width, height, profiles[profile],
+                             target, version))
+
+        return jobs, cached
+
+    def warm(self, cache_path=None, *sizes):
+        if not cache_path:
+            error_msg = 'missing cache path, try something ' \
+                        'like "bob warm /srv/images/cache 200x100"'
+            sys.stderr.write("\n%s\n" % error_msg)
+            self.exit()
+
+        self.configure()
+
+        sizes = sizes or cherrypy.config.get('image.sizes') or []
+        parsed = []
+        for size in sizes:
+            if parse_size(size) is None:
+                sys.stderr.write('\n%r is not a size like 200x100\n' % size)
+                self.exit()
+
+            parsed.append(parse_size(size))
+
+        if not parsed:
+            error_msg = 'missing sizes, give them after the cache path ' \
+                        'or set image-sizes in settings.yml'
+            sys.stderr.write("\n%s\n" % error_msg)
+            self.exit()
+
+        handler = ImageHandler(cache_at=cache_path)
+        jobs, cached = self.get_warm_jobs(handler, parsed)
+        total = len(jobs) + cached
+
+        workers = cherrypy.config.get('image.workers') or \
+                  multiprocessing.cpu_count()
+
+        if workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(warm_variant, jobs)
+        else:
+            pool = None
+            results = (warm_variant(job) for job in jobs)
+
+        failed = 0
+        done = cached
+        try:
+            for target, error in results:
+                done += 1
+                if error:
+                    failed += 1
+                    sys.stdout.write('\nfailed to render %s: %s\n' % \
+                                     (target, error))
+
+                sys.stdout.write('\rwarming %s: %d/%d' % \
+                                 (cache_path, done, total))
+                sys.stdout.flush()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        sys.stdout.write('\nrendered %d images, %d were already cached, ' \
+                         '%d failed\n' % (len(jobs) - failed, cached, failed))
+
+        return failed and 1 or 0
+
+def warm_variant(job):
+    '''Renders and caches a single image for "bob warm", returning the
+    cache path and the error, if any. It lives at module level so that
+    it can run within worker processes.'''
+    source, width, height, profile, target, version = job
+    try:
+        data = render_picture(source, width, height, True, True, 0xffffff,
+                              profile)
+        ImageHandler().store(target, data, version)
+    except Exception, e:
+        return target, str(e) or e.__class__.__name__
+
+    return target, None
+
 def run(*args, **kw):
     bob = Bob(*args, **kw)
     sys.exit(bob.run())
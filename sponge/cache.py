@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <Sponge - Lightweight Web Framework>
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+# Copyright (C) 2009 Bernardo Heynemann <heynemann@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import threading
+
+class CacheItem(object):
+    __slots__ = ('key', 'value', 'size', 'expires', 'prev', 'next')
+
+    def __init__(self, key, value, size, expires):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.prev = None
+        self.next = None
+
+class LRUCache(object):
+    '''A thread-safe cache which forgets the least recently used
+    items when it gets more than max_entries items, or when the sum of
+    the items' sizes, as given by the sizeof function, gets bigger
+    than max_size. Each item can also have a time to live, in
+    seconds.'''
+
+    def __init__(self, max_entries=100, max_size=None, sizeof=len):
+        for name, value in (('max_entries', max_entries),
+                            ('max_size', max_size)):
+            if value is None:
+                continue
+
+            if not isinstance(value, (int, long)) or value < 1:
+                raise TypeError, 'LRUCache takes a positive integer as ' \
+                      '%s parameter, got %s.' % (name, repr(value))
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = {}
+        self._head = None
+        self._tail = None
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            'entries': len(self._items),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _unlink(self, item):
+        if item.prev is None:
+            self._head = item.next
+        else:
+            item.prev.next = item.next
+
+        if item.next is None:
+            self._tail = item.prev
+        else:
+            item.next.prev = item.prev
+
+        item.prev = item.next = None
+
+    def _push(self, item):
+        item.next = self._head
+        if self._head is not None:
+            self._head.prev = item
+
+        self._head = item
+        if self._tail is None:
+            self._tail = item
+
+    def _remove(self, item):
+        self._unlink(item)
+        del self._items[item.key]
+        self.size -= item.size
+
+    def _is_full(self):
+        if self.max_entries is not None and \
+               len(self._items) > self.max_entries:
+            return True
+
+        return self.max_size is not None and self.size > self.max_size
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+
+            if item.expires is not None and item.expires <= time.time():
+                self._remove(item)
+                self.misses += 1
+                return default
+
+            self._unlink(item)
+            self._push(item)
+            self.hits += 1
+            return item.value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+
+        size = 0
+        if self.max_size is not None:
+            size = self.sizeof(value)
+
+        self._lock.acquire()
+        try:
+            if key in self._items:
+                self._remove(self._items[key])
+
+            # an item bigger than the whole cache would evict everything
+            if self.max_size is not None and size > self.max_size:
+                return
+
+            item = CacheItem(key, value, size, expires)
+            self._items[key] = item
+            self._push(item)
+            self.size += size
+
+            while self._is_full():
+                self._remove(self._tail)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._items:
+                self._remove(self._items[key])
+        finally:
+            self._lock.release()
+
+    def delete_if(self, predicate):
+        '''Removes all the items whose key matches the given
+        predicate, returns how many were removed.'''
+        self._lock.acquire()
+        try:
+            items = [i for k, i in self._items.items() if predicate(k)]
+            for item in items:
+                self._remove(item)
+
+            return len(items)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._items.clear()
+            self._head = self._tail = None
+            self.size = 0
+        finally:
+            self._lock.release()
+
+class DiskUsage(object):
+    '''Keeps track of the size and use of the files of a disk cache,
+    and tells which of them should be removed once their sizes sum up
+    to more than max_size bytes. The "lru" policy removes the least
+    recently used files first, while "lfu" removes the least
+    frequently used ones first. Files are removed until the cache is
+    down to low_water of max_size, so that a full cache does not
+    evict on every write.'''
+
+    policies = ('lru', 'lfu')
+
+    def __init__(self, max_size, policy='lru', low_water=0.9):
+        if not isinstance(max_size, (int, long)) or max_size < 1:
+            raise TypeError, 'DiskUsage takes a positive integer as ' \
+                  'max_size parameter, got %s.' % repr(max_size)
+
+        if policy not in self.policies:
+            raise ValueError, 'DiskUsage policy must be one of %s, ' \
+                  'got %s.' % (', '.join(self.policies), repr(policy))
+
+        self.max_size = max_size
+        self.policy = policy
+        self.low_water = int(max_size * low_water)
+        self.size = 0
+        self.evictions = 0
+        # path -> [size, last access, number of accesses]
+        self._files = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {
+            'entries': len(self._files),
+            'size': self.size,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _rank(self, path):
+        size, accessed, uses = self._files[path]
+        if self.policy == 'lfu':
+            return uses, accessed
+
+        return accessed
+
+    def add(self, path, size):
+        '''Records a file written to the cache, returns the list of
+        paths that must be removed from disk to make room for it.'''
+        self._lock.acquire()
+        try:
+            if path in self._files:
+                self.size -= self._files[path][0]
+
+            self._files[path] = [size, self._tick(), 1]
+            self.size += size
+
+            if self.size <= self.max_size:
+                return []
+
+            victims = []
+            for victim in sorted(self._files, key=self._rank):
+                if self.size <= self.low_water:
+                    break
+
+                if victim == path:
+                    continue
+
+                self.size -= self._files.pop(victim)[0]
+                self.evictions += 1
+                victims.append(victim)
+
+            return victims
+        finally:
+            self._lock.release()
+
+    def touch(self, path):
+        '''Records a cache hit on the given file.'''
+        self._lock.acquire()
+        try:
+            entry = self._files.get(path)
+            if entry is not None:
+                entry[1] = self._tick()
+                entry[2] += 1
+        finally:
+            self._lock.release()
+
+    def discard(self, path):
+        self._lock.acquire()
+        try:
+            entry = self._files.pop(path, None)
+            if entry is not None:
+                self.size -= entry[0]
+        finally:
+            self._lock.release()
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    '''Coalesces concurrent calls sharing the same key: the first
+    caller runs the function, while the others wait for it to finish
+    and get the same result, or exception.'''
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kw):
+        self._lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        finally:
+            self._lock.release()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+
+        try:
+            flight.result = function(*args, **kw)
+            return flight.result
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+            finally:
+                self._lock.release()
+
+            flight.done.set()
@@ -17,28 +17,188 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
+import hmac
+import time
+import errno
+import Queue
+import thread
+import urllib
+import hashlib
 import cherrypy
+import threading
 
-from cherrypy.lib import static
+from cherrypy.lib import cptools, httputil
 
+from sponge.cache import DiskUsage, LRUCache, SingleFlight
 from sponge.core.io import FileSystem
-from sponge.helpers.image import jpeg, picture
+from sponge.helpers.image import jpeg, picture, profiles, image_info, \
+     get_profile_name, get_content_type, negotiate, send_file, is_supported
+from sponge.template import make_url
 
 class InvalidCachePath(IOError):
     pass
 
+def parse_size(size):
+    '''Returns (width, height) for sizes like "200x100" or (200, 100),
+    or None if the given size is not like any of these.'''
+    if isinstance(size, (tuple, list)) and len(size) == 2:
+        size = '%sx%s' % tuple(size)
+
+    match = re.match(r'^(?P<width>\d+)x(?P<height>\d+)$', str(size))
+    if not match:
+        return None
+
+    return int(match.group('width')), int(match.group('height'))
+
+def same_signature(given, expected):
+    '''Compares the signatures in constant time, so that they can not
+    be guessed by timing the responses.'''
+    if len(given) != len(expected):
+        return False
+
+    result = 0
+    for x, y in zip(given, expected):
+        result |= ord(x) ^ ord(y)
+
+    return result == 0
+
+class BackgroundRenderer(object):
+    '''Renders image variants within daemon threads, so that the pages
+    linking to them do not have to wait for them. At most queue_size
+    variants can be waiting at once, the others are rendered when they
+    are requested.'''
+
+    def __init__(self, workers=1, queue_size=1000):
+        self.queue = Queue.Queue(queue_size)
+        self.pending = set()
+        self._lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work,
+                                      name='sponge-image-renderer-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.threads.append(worker)
+
+    def schedule(self, handler, *args):
+        '''Schedules handler.prerender(*args), returns False when it is
+        already scheduled or when the queue is full.'''
+        job = (handler, ) + args
+        self._lock.acquire()
+        try:
+            if job in self.pending:
+                return False
+
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                return False
+
+            self.pending.add(job)
+            return True
+        finally:
+            self._lock.release()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job[0].prerender(*job[1:])
+            except Exception:
+                cherrypy.log('Could not render %r' % (job[1:], ),
+                             'IMAGE', traceback=True)
+
+            self._lock.acquire()
+            try:
+                self.pending.discard(job)
+            finally:
+                self._lock.release()
+
+            self.queue.task_done()
+
+    def join(self):
+        '''Waits until all the scheduled variants are rendered.'''
+        self.queue.join()
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_renderer():
+    '''Returns the BackgroundRenderer, with as many threads as the
+    "image.background_workers" setting, one by default.'''
+    global _renderer
+    _renderer_lock.acquire()
+    try:
+        if _renderer is None:
+            workers = cherrypy.config.get('image.background_workers', 1)
+            _renderer = BackgroundRenderer(workers)
+    finally:
+        _renderer_lock.release()
+
+    return _renderer
+
 class ImageHandler(object):
     exposed = True
     should_cache = False
     cache_path = None
+    memory = None
+    disk = None
+    profile = None
+    max_age = 365 * 24 * 60 * 60
+    sizes = None
+    secret = None
+    base_url = None
+    # the cached images bigger than this fraction of the memory cache
+    # are sent straight from disk instead of being read into it
+    memory_item_fraction = 8
+    # temporary files younger than this, in seconds, may still be
+    # written by other threads or processes, such as "bob warm"
+    stale_temporary_age = 60 * 60
     fs = FileSystem()
 
-    def __init__(self, cache_at=None):
+    def __init__(self, cache_at=None, memory_cache_size=None,
+                 cache_max_size=None, cache_policy='lru', profile=None,
+                 max_age=None, sizes=None, secret=None, base_url=None):
         if not isinstance(cache_at, (basestring, type(None))):
             raise TypeError, 'The path given to ImageHandler ' \
                   'to cache must be a string, got %s' % repr(cache_at)
 
+        if profile is not None:
+            self.profile = self.get_profile_name(profile)
+
+        if max_age is not None:
+            self.max_age = max_age
+
+        # only these sizes are rendered, when given
+        if sizes is not None:
+            self.sizes = set()
+            for size in sizes:
+                parsed = parse_size(size)
+                if parsed is None:
+                    raise TypeError, 'ImageHandler takes sizes like ' \
+                          '"200x100", got %s' % repr(size)
+                self.sizes.add(parsed)
+
+        if secret is not None:
+            if not isinstance(secret, basestring):
+                raise TypeError, 'The secret given to ImageHandler ' \
+                      'must be a string, got %s' % repr(secret)
+            self.secret = str(secret)
+
+        # where the handler is mounted, to build the urls of srcset()
+        if base_url is not None:
+            self.base_url = base_url.rstrip('/')
+
+        self.in_flight = SingleFlight()
+
+        # the hottest images are also kept in memory, up to
+        # memory_cache_size bytes
+        if memory_cache_size:
+            self.memory = LRUCache(max_entries=None,
+                                   max_size=memory_cache_size)
+
         if cache_at:
             self.should_cache =True
             self.cache_path = cache_at
@@ -49,41 +209,407 @@ class ImageHandler(object):
                       'so that ImageHandler can not save ' \
                       'cache files there.' % cache_at
 
+            if cache_max_size:
+                self.disk = DiskUsage(cache_max_size, cache_policy)
+                self.scan()
+
+    def scan(self):
+        '''Records the files cached by previous runs in self.disk,
+        oldest first, and removes temporary files left behind by
+        interrupted writes.
+
+        The modification time of the cached files is the one of their
+        source, so their age is taken from the time they were written,
+        their status change time.'''
+        now = time.time()
+        cached = []
+        for full_path in self.fs.locate(self.cache_path, '*'):
+            try:
+                info = self.fs.stat(full_path)
+            except OSError, e:
+                # renamed or removed by another process meanwhile
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            if full_path.endswith('.tmp'):
+                if now - info.st_ctime > self.stale_temporary_age:
+                    self.fs.remove(full_path)
+                continue
+
+            cached.append((info.st_ctime, full_path, info.st_size))
+
+        for ctime, full_path, size in sorted(cached):
+            for victim in self.disk.add(full_path, size):
+                self.fs.remove(victim)
+
     def get_cache_path(self, path):
         return self.fs.join(self.cache_path, path.lstrip('/'))
 
+    def get_key(self, path, profile='original'):
+        '''Returns the key the given image is cached with, the images
+        encoded with other profiles than "original" are cached apart.'''
+        if profile != 'original':
+            return '@%s/%s' % (profile, path)
+
+        return path
+
+    def get_variant(self, args):
+        '''Returns (path, width, height) for /crop/<width>x<height>/path
+        urls, or None when the original image is requested. Sizes
+        written any other way, like "0200x100", are not variants, so
+        that each variant is rendered and cached under a single url.'''
+        if len(args) >= 3 and args[0] == 'crop':
+            size = parse_size(args[1])
+            if size is not None and '%dx%d' % size == args[1]:
+                return ("/".join(args[2:]), ) + size
+
+        return None
+
+    def get_temporary_path(self, cache_full_path):
+        return '%s.%d-%d.tmp' % (cache_full_path, os.getpid(),
+                                 thread.get_ident())
+
+    def store(self, cache_full_path, image, version=None):
+        '''Writes the given image to the cache. The modification time of
+        the file is set to the one of the given source version, so that
+        is_fresh() can tell when the source is replaced.'''
+        dir_path = self.fs.dirname(cache_full_path)
+        self.fs.mkdir(dir_path)
+
+        # the image is written aside and then renamed, so that other
+        # threads or processes never serve a partially written file
+        temporary_path = self.get_temporary_path(cache_full_path)
+        img_file = self.fs.open_raw(temporary_path, 'w')
+        try:
+            img_file.write(image)
+        finally:
+            img_file.close()
+
+        if version is not None:
+            self.fs.utime(temporary_path, version[0])
+
+        self.fs.rename(temporary_path, cache_full_path)
+
+        if self.disk is not None:
+            for victim in self.disk.add(cache_full_path, len(image)):
+                self.fs.remove(victim)
+
+    def get_profile_name(self, name=None):
+        '''Works like sponge.helpers.image.get_profile_name, but also
+        refuses the profiles whose format the installed PIL can not
+        write, since any client can ask for them.'''
+        profile = get_profile_name(name)
+        if not is_supported(profile):
+            raise ValueError('The image profile %r needs the %s format, ' \
+                             'which the installed PIL can not write.' % \
+                             (profile, profiles[profile]['format']))
+
+        return profile
+
+    def get_profile(self, name=None):
+        '''Returns the name of the profile to encode the images with:
+        the one given in the url, the one given to the handler or the
+        configured one, in that order, or one it prefers which is
+        accepted by the client.'''
+        profile = self.get_profile_name(name or self.profile)
+        if profiles[profile].get('prefer'):
+            cherrypy.response.headers['Vary'] = 'Accept'
+            accepted = [element.value for element in
+                        cherrypy.request.headers.elements('Accept')
+                        if element.qvalue > 0]
+            profile = negotiate(profile, accepted)
+
+        return profile
+
+    def sign(self, path, profile=None):
+        '''Returns the signature of the given image url, relative to
+        the handler, like "crop/200x100/dog.jpg".'''
+        message = path.lstrip('/')
+        if profile:
+            message = '%s?profile=%s' % (message, profile)
+
+        return hmac.new(self.secret, message, hashlib.sha1).hexdigest()
+
+    def get_url(self, path, width, height, profile=None):
+        '''Returns the url of the given image cropped to the given size,
+        relative to the handler, and signed when the handler has a
+        secret. The path is quoted in the url, but signed unquoted, as
+        CherryPy gives it back.'''
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+
+        url = 'crop/%dx%d/%s' % (width, height, path.lstrip('/'))
+        params = []
+        if profile:
+            params.append('profile=%s' % profile)
+        if self.secret is not None:
+            params.append('sign=%s' % self.sign(url, profile))
+
+        url = urllib.quote(url)
+
+        if params:
+            url = '%s?%s' % (url, '&'.join(params))
+
+        return url
+
+    def is_allowed(self, path, variant, kw):
+        '''Tells whether the requested variant has one of the allowed
+        sizes and, when the handler has a secret, whether it is signed.
+        The original images are always allowed.'''
+        if variant is None:
+            return True
+
+        if self.sizes is not None and variant[1:] not in self.sizes:
+            return False
+
+        if self.secret is not None:
+            signature = str(kw.get('sign') or '')
+            expected = self.sign(path, kw.get('profile'))
+            if not same_signature(signature, expected):
+                return False
+
+        return True
+
+    def get_version(self, source):
+        '''Returns the modification time and size of the given source
+        image, relative to "image.dir", or None when it can not be
+        found.'''
+        image_dir = cherrypy.config.get('image.dir')
+        if not image_dir:
+            return None
+
+        try:
+            info = self.fs.stat(self.fs.join(image_dir, source))
+        except OSError:
+            return None
+
+        return info.st_mtime, info.st_size
+
+    def get_memory_key(self, key, version):
+        '''Returns the key of the image in the memory cache, which
+        includes the version of its source, so that the images rendered
+        from a replaced source are never served again.'''
+        if version is None:
+            return key
+
+        return '%s:%r:%d' % ((key, ) + tuple(version))
+
+    def is_fresh(self, cache_full_path, version):
+        '''Tells whether the cached file was rendered from the given
+        version of its source, whose modification time it keeps. The
+        times are compared to the second, like Last-Modified, since
+        the cache may live in a filesystem with coarser timestamps.'''
+        if version is None:
+            return True
+
+        try:
+            mtime = self.fs.stat(cache_full_path).st_mtime
+        except OSError:
+            return False
+
+        return int(mtime) == int(version[0])
+
+    def validate(self, key, version):
+        '''Sets the ETag, Last-Modified and Cache-Control headers of the
+        image, which only change along with the source image and the
+        variant, and answers "304 Not Modified" to the clients which
+        already have it, before any image is read.'''
+        if version is None:
+            return
+
+        validator = self.get_memory_key(key, version)
+        headers = cherrypy.response.headers
+        headers['ETag'] = '"%s"' % hashlib.md5(validator).hexdigest()
+        headers['Last-Modified'] = httputil.HTTPDate(version[0])
+        if self.max_age:
+            headers['Cache-Control'] = 'public, max-age=%d' % self.max_age
+
+        cptools.validate_etags()
+        cptools.validate_since()
+
+    def render_variant(self, cache_full_path, path, width, height,
+                       profile='original', version=None):
+        image = picture(path=path, width=width, height=height,
+                        profile=profile)
+        if self.should_cache:
+            self.store(cache_full_path, image, version)
+
+        return image
+
+    def render(self, key, cache_full_path, variant, profile, version=None):
+        # concurrent requests to the same variant wait for a single
+        # render instead of rendering it again
+        image = self.in_flight.do(cache_full_path or key,
+                                  self.render_variant,
+                                  cache_full_path, *variant,
+                                  profile=profile, version=version)
+
+        if self.memory is not None:
+            self.memory.set(self.get_memory_key(key, version), image)
+
+        return image
+
+    def is_cached(self, key, version=None):
+        if self.memory is not None and \
+               self.get_memory_key(key, version) in self.memory:
+            return True
+
+        if self.should_cache:
+            cache_full_path = self.get_cache_path(key)
+            return self.fs.exists(cache_full_path) and \
+                   self.is_fresh(cache_full_path, version)
+
+        return False
+
+    def prerender(self, path, width, height, profile='original'):
+        '''Renders and caches the given variant unless it is cached.'''
+        key = self.get_key('crop/%dx%d/%s' % (width, height, path), profile)
+        version = self.get_version(path)
+        if self.is_cached(key, version):
+            return
+
+        cache_full_path = None
+        if self.should_cache:
+            cache_full_path = self.get_cache_path(key)
+
+        self.render(key, cache_full_path, (path, width, height), profile,
+                    version)
+
+    def srcset(self, path, widths, profile=None):
+        '''Returns the value of the srcset attribute of an <img> showing
+        the given image, relative to "image.dir", at each of the given
+        widths, keeping its proportions. The widths bigger than the
+        image are left out. The variants which are not cached yet are
+        rendered in background, so that they are ready by the time the
+        browser asks for them.'''
+        if self.base_url is None:
+            raise ValueError('ImageHandler needs to know its base_url ' \
+                             'to build srcset urls.')
+
+        path = path.lstrip('/')
+        info = image_info(path)
+        if info is None:
+            return ''
+
+        source_width, source_height = info['width'], info['height']
+        widths = [w for w in sorted(set(widths)) if w <= source_width]
+        if not widths:
+            widths = [source_width]
+
+        render_profile = self.get_profile_name(profile or self.profile)
+        background = self.should_cache or self.memory is not None
+        version = info['mtime'], info['size']
+
+        candidates = []
+        for width in widths:
+            height = max(1, int(round(width * source_height /
+                                      float(source_width))))
+            if self.sizes is not None and (width, height) not in self.sizes:
+                continue
+
+            url = self.get_url(path, width, height, profile)
+            candidates.append('%s %dw' % (make_url('%s/%s' % (self.base_url,
+                                                                url)), width))
+
+            key = self.get_key('crop/%dx%d/%s' % (width, height, path),
+                               render_profile)
+            if background and not self.is_cached(key, version):
+                get_renderer().schedule(self, path, width, height,
+                                        render_profile)
+
+        return ', '.join(candidates)
+
+    def is_large(self, cache_full_path):
+        size = self.fs.stat(cache_full_path).st_size
+        return size > self.memory.max_size / self.memory_item_fraction
+
+    def load(self, cache_full_path):
+        img_file = self.fs.open_raw(cache_full_path, 'rb')
+        try:
+            return img_file.read()
+        finally:
+            img_file.close()
+
     def __call__(self, *args, **kw):
         if len(args) < 1:
             cherrypy.response.status = 404
             return "not found"
 
+        try:
+            profile = self.get_profile(kw.get('profile'))
+        except ValueError, e:
+            cherrypy.response.status = 400
+            return unicode(e)
+
+        content_type = get_content_type(profile)
         path = "/".join(args)
+        key = self.get_key(path, profile)
+
+        variant = self.get_variant(args)
+        if not self.is_allowed(path, variant, kw):
+            cherrypy.response.status = 403
+            return "forbidden"
+
+        if variant is None:
+            version = self.get_version(path)
+        else:
+            version = self.get_version(variant[0])
+
+        self.validate(key, version)
 
-        image = jpeg(path=path)
+        memory_key = self.get_memory_key(key, version)
+        if self.memory is not None:
+            image = self.memory.get(memory_key)
+            if image is not None:
+                cherrypy.response.headers['Content-Type'] = content_type
+                return image
 
         cache_full_path = None
 
         if self.should_cache:
-            cache_full_path = self.get_cache_path(path)
-            if self.fs.exists(cache_full_path):
-                return static.serve_file(cache_full_path, 'image/jpeg')
+            cache_full_path = self.get_cache_path(key)
+            # the cached files rendered from another version of their
+            # source are rendered again
+            if self.fs.exists(cache_full_path) and \
+                   self.is_fresh(cache_full_path, version):
+                if self.disk is not None:
+                    self.disk.touch(cache_full_path)
 
-        if len(args) >= 3 and args[0] == 'crop':
-            proportion = re.match(r'(?P<width>\d+)x(?P<height>\d+)',
-                                  args[1])
-            if proportion:
-                width = int(proportion.group('width'))
-                height = int(proportion.group('height'))
+                if self.memory is None or self.is_large(cache_full_path):
+                    # serve_file sends the modification time of the
+                    # cache file, the one of the source is kept instead
+                    headers = cherrypy.response.headers
+                    last_modified = headers.get('Last-Modified')
+                    image = send_file(cache_full_path, content_type)
+                    if last_modified:
+                        headers['Last-Modified'] = last_modified
+                    return image
 
-                image = picture(path="/".join(args[2:]),
-                                width=width,
-                                height=height)
+                image = self.load(cache_full_path)
+                self.memory.set(memory_key, image)
+                cherrypy.response.headers['Content-Type'] = content_type
+                return image
 
-        if self.should_cache:
-            dir_path = self.fs.dirname(cache_full_path)
-            self.fs.mkdir(dir_path)
-            img_file = self.fs.open_raw(cache_full_path, 'w')
-            img_file.write(image)
-            img_file.close()
+        if variant is None:
+            image = jpeg(path=path, profile=profile)
+
+            # only the images encoded by PIL are cached: jpeg() returns an
+            # unicode error message when the image could not be found, and
+            # the body of the original file when it is already a JPEG
+            if isinstance(image, str):
+                if self.should_cache:
+                    self.store(cache_full_path, image, version)
+                if self.memory is not None:
+                    self.memory.set(memory_key, image)
+            elif isinstance(image, unicode):
+                # the source could not be read, so the error must not
+                # be cached nor validated as if it were the image
+                for name in ('ETag', 'Last-Modified', 'Cache-Control'):
+                    cherrypy.response.headers.pop(name, None)
+
+            return image
 
+        image = self.render(key, cache_full_path, variant, profile, version)
+        cherrypy.response.headers['Content-Type'] = content_type
         return image
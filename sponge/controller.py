@@ -20,6 +20,24 @@
 import re
 import cherrypy
 
+ROUTE_VARIABLE = re.compile(r'^(?:[:*](?P<name>\w+)|[{](?P<braced>\w+)[}])$')
+
+# maps each route name to its parts, a list of (is_variable, text)
+routes_index = {}
+
+def register_route(name, route):
+    '''Keeps the given route, already split in its parts, so that
+    sponge.template.url_for can build urls to it by name.'''
+    parts = []
+    for part in route.split('/'):
+        found = ROUTE_VARIABLE.match(part)
+        if found:
+            parts.append((True, found.group('name') or found.group('braced')))
+        else:
+            parts.append((False, part))
+
+    routes_index[name] = parts
+
 def route(route, name=None):
     def dec(func):
         conf = (
@@ -20,9 +20,12 @@
 import os
 import re
 import sys
+import time
 import cherrypy
 
 from sponge.core.io import FileSystem, ClassLoader
+from sponge.template import get_loader, CACHE_SIZE
+from sponge.controller import register_route
 
 class InvalidValueError(Exception):
     pass
@@ -50,6 +53,17 @@ class ConfigValidator(object):
         'host': r'^\d{1,3}[.]\d{1,3}[.]\d{1,3}[.]\d{1,3}$',
         'port': r'^\d+$',
         'autoreload': AnyValue(bool),
+        'template-autoreload': AnyValue(bool),
+        'template-precompile': AnyValue(bool),
+        'template-gzip': AnyValue(bool),
+        'template-cache-size': AnyValue(int),
+        'image-workers': AnyValue(int),
+        'image-queue': AnyValue(int),
+        'image-profile': r'^[\w-]+$',
+        'image-sizes': AnyValue(list),
+        'image-index': r'^.+$',
+        'image-sendfile': r'^[\w-]+$',
+        'image-sendfile-prefix': r'^.*$',
         'application': {
             r'^[a-zA-Z_-][\w_-]*$': r'^[/].*$'
         },
@@ -142,6 +156,30 @@ class SpongeConfig(object):
     def set_setting(self, key, value):
         self.d[key] = value
 
+    def precompile_templates(self, template_path, auto_reload):
+        '''Parses all the *.html files within template_path, so that
+        they are already compiled when the first requests arrive.
+        Returns the number of compiled templates and how many seconds
+        it took.
+
+        The loader only keeps "template.cache_size" compiled
+        templates, so a warning is written when there are more than
+        that, since the first ones compiled were forgotten again.'''
+        loader = get_loader(template_path, auto_reload)
+        started = time.time()
+        filenames = self.fs.locate(template_path, '*.html')
+        for filename in filenames:
+            loader.load(os.path.relpath(filename, template_path))
+
+        cache_size = cherrypy.config.get('template.cache_size', CACHE_SIZE)
+        if len(filenames) > cache_size:
+            msg = '\nWARNING: found %d templates, but only %d are kept ' \
+                  'compiled, set template-cache-size in settings.yml ' \
+                  'to keep all of them\n' % (len(filenames), cache_size)
+            sys.stderr.write(msg)
+
+        return len(filenames), time.time() - started
+
     def setup_all(self, current_full_path):
         sys.path.append(os.getcwd())
         if not isinstance(current_full_path, basestring):
@@ -164,6 +202,15 @@ class SpongeConfig(object):
         self.set_setting('sponge', cdict)
         self.set_setting('sponge.root', sponge_root)
         self.set_setting('engine.autoreload_on', cdict['autoreload'])
+        template_auto_reload = cdict.get('template-autoreload',
+                                         cdict['autoreload'])
+        self.set_setting('template.auto_reload', template_auto_reload)
+        if 'template-gzip' in cdict:
+            self.set_setting('template.gzip', cdict['template-gzip'])
+
+        if 'template-cache-size' in cdict:
+            self.set_setting('template.cache_size',
+                             cdict['template-cache-size'])
         if 'extra' in cdict:
             self.set_setting('sponge.extra', cdict['extra'])
 
@@ -183,10 +230,33 @@ class SpongeConfig(object):
         template_path = self.fs.join(current_full_path, template_dir)
         self.set_setting('template.dir', template_path)
 
+        if cdict.get('template-precompile'):
+            count, seconds = self.precompile_templates(template_path,
+                                                       template_auto_reload)
+            sys.stdout.write('Sponge compiled %d templates in %.3f ' \
+                             'seconds\n' % (count, seconds))
+
         image_dir = application['image-dir']
         image_path = self.fs.join(current_full_path, image_dir)
         self.set_setting('image.dir', image_path)
 
+        if 'image-workers' in cdict:
+            self.set_setting('image.workers', cdict['image-workers'])
+        if 'image-queue' in cdict:
+            self.set_setting('image.queue_size', cdict['image-queue'])
+        if 'image-profile' in cdict:
+            self.set_setting('image.profile', cdict['image-profile'])
+        if 'image-sizes' in cdict:
+            self.set_setting('image.sizes', cdict['image-sizes'])
+        if 'image-index' in cdict:
+            index_path = self.fs.join(current_full_path, cdict['image-index'])
+            self.set_setting('image.index', index_path)
+        if 'image-sendfile' in cdict:
+            self.set_setting('image.sendfile', cdict['image-sendfile'])
+        if 'image-sendfile-prefix' in cdict:
+            self.set_setting('image.sendfile_prefix',
+                             cdict['image-sendfile-prefix'])
+
         adir = application['path']
         application_path = self.fs.join(current_full_path, adir)
 
@@ -238,6 +308,7 @@ class SpongeConfig(object):
                 part1 = mountpoint.rstrip('/')
                 part2 = v['route'].lstrip('/')
                 new_route = "/".join([part1, part2])
+                register_route(k, new_route)
                 dispatcher.connect(name=k,
                                    route=new_route,
                                    controller=cls(),
@@ -97,6 +97,33 @@ class FileSystem(object):
         '''Returns the directory name for the given file.'''
         return dirname(path)
 
+    @classmethod
+    def rename(cls, source, destination):
+        '''Moves source to destination, replacing it if it exists.
+        When both are in the same filesystem, readers see either the
+        old or the new file, never a partially written one.'''
+        os.rename(source, destination)
+
+    @classmethod
+    def remove(cls, path):
+        '''Removes the given file, if it exists.'''
+        try:
+            os.remove(path)
+        except OSError, e:
+            # ignore if the file was already removed
+            if e.errno not in (2, ):
+                raise e
+
+    @classmethod
+    def stat(cls, path):
+        return os.stat(path)
+
+    @classmethod
+    def utime(cls, path, mtime):
+        '''Sets both the access and modification times of the given
+        file to mtime.'''
+        os.utime(path, (mtime, mtime))
+
     @classmethod
     def walk(cls, path):
         '''Walks through filesystem'''
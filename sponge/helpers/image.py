@@ -19,11 +19,127 @@
 
 import os
 import Image
+import cPickle
 import ImageDraw
+import ImageFile
 import cherrypy
 import StringIO
+import threading
+import multiprocessing
 
-def jpeg(path, base_path=None):
+from multiprocessing import TimeoutError
+from cherrypy.lib import cptools, httputil, static
+from sponge.core.io import FileSystem
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff')
+
+# Named sets of options used to encode the images. Besides the
+# format and the options given to PIL, a profile can name other
+# profiles to "prefer" when the client accepts their content type.
+profiles = {
+    # what jpeg() and picture() always did, the default
+    'original': {'format': 'JPEG', 'quality': 100},
+    'high': {'format': 'JPEG', 'quality': 90, 'optimize': True,
+             'progressive': True, 'subsampling': '4:4:4'},
+    'web': {'format': 'JPEG', 'quality': 80, 'optimize': True,
+            'progressive': True, 'prefer': ['webp']},
+    'png': {'format': 'PNG', 'optimize': True},
+    'webp': {'format': 'WEBP', 'quality': 80},
+}
+
+content_types = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+}
+
+def register_profile(name, format='JPEG', **options):
+    if format not in content_types:
+        raise ValueError('Image profiles must have one of the formats ' \
+                         '%s, got %r.' % (', '.join(sorted(content_types)),
+                                          format))
+    options['format'] = format
+    profiles[name] = options
+
+def get_profile_name(name=None):
+    '''Returns the given profile name, or the one configured through
+    the "image.profile" setting, which defaults to "original".'''
+    if name is None:
+        name = cherrypy.config.get('image.profile', 'original')
+
+    if name not in profiles:
+        raise ValueError('There is no image profile called %r.' % name)
+
+    return name
+
+def is_supported(name):
+    '''Tells whether the installed PIL can write the format of the
+    given profile.'''
+    Image.init()
+    return profiles[name]['format'] in Image.SAVE
+
+def get_content_type(name):
+    return content_types[profiles[name]['format']]
+
+def negotiate(name, accepted):
+    '''Returns the first profile the given profile prefers which is
+    supported and whose content type is explicitly listed in the given
+    accepted content types, or the given profile itself.'''
+    for preferred in profiles[name].get('prefer', []):
+        if preferred in profiles and \
+               get_content_type(preferred) in accepted and \
+               is_supported(preferred):
+            return preferred
+
+    return name
+
+def encode(img, profile):
+    '''Encodes the given image with the options of the given profile
+    dict, returning the image data.'''
+    options = dict(profile)
+    format = options.pop('format')
+    options.pop('prefer', None)
+
+    # PIL turns these on when they are given at all, even as False
+    for flag in ('optimize', 'progressive'):
+        if not options.get(flag):
+            options.pop(flag, None)
+
+    # optimized and progressive JPEG files are written in a single
+    # block, which must fit the whole image
+    if format == 'JPEG' and ('optimize' in options or 'progressive' in options):
+        ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK,
+                                 img.size[0] * img.size[1] * 4)
+
+    if format != 'PNG' and img.mode not in ('RGB', 'L', 'CMYK'):
+        img = img.convert('RGB')
+
+    sfile = StringIO.StringIO()
+    img.save(sfile, format, **options)
+    return sfile.getvalue()
+
+def send_file(fullpath, content_type):
+    '''Sends the given file without reading it into memory. When the
+    "image.sendfile" setting names a header, like X-Sendfile or
+    X-Accel-Redirect, the file is left for the front-end server to
+    send, at its path prefixed by the "image.sendfile_prefix" setting.
+    Otherwise CherryPy streams it from disk, with its Content-Length.'''
+    header = cherrypy.config.get('image.sendfile')
+    if not header:
+        return static.serve_file(fullpath, content_type)
+
+    headers = cherrypy.response.headers
+    if 'Last-Modified' not in headers:
+        mtime = os.stat(fullpath).st_mtime
+        headers['Last-Modified'] = httputil.HTTPDate(mtime)
+        cptools.validate_since()
+
+    prefix = cherrypy.config.get('image.sendfile_prefix', '')
+    headers['Content-Type'] = content_type
+    headers[header] = prefix + os.path.abspath(fullpath)
+    return ''
+
+def jpeg(path, base_path=None, profile=None):
     if not isinstance(path, basestring):
         raise TypeError('jpeg() takes a string as parameter, got %r.' % path)
 
@@ -38,16 +154,37 @@ def jpeg(path, base_path=None):
         cherrypy.response.status = 404
         return unicode(e)
 
+    profile = get_profile_name(profile)
 
-    sfile = StringIO.StringIO()
-    img.save(sfile, "JPEG", quality=100)
-    cherrypy.response.headers['Content-type'] = "image/jpeg"
-    return sfile.getvalue()
+    # Image.open only reads the header, so JPEG files are sent as they
+    # are, without being decoded and encoded again
+    if img.format == 'JPEG' and profile == 'original':
+        return send_file(fullpath, 'image/jpeg')
+
+    data = encode(img, profiles[profile])
+    cherrypy.response.headers['Content-type'] = get_content_type(profile)
+    return data
 
 # Based in the original, public license, version from Kevin Cazabon
 # <http://www.cazabon.com/python/>
 
+# when the cropped area is at least RESAMPLE_GAP times bigger than the
+# output size, it is first reduced with a cheap filter down to
+# RESAMPLE_GAP times the output size, and only then antialiased
+RESAMPLE_GAP = 3
+
 def crop_to_fit(img, output_size):
+    # JPEG files can be decoded straight at 1/2, 1/4 or 1/8 of their
+    # size, which is much faster and lighter than decoding the whole
+    # image just to throw most of it away. The draft is never smaller
+    # than the size that still covers the output size.
+    if img.format == 'JPEG':
+        scale = max(float(output_size[0]) / img.size[0],
+                    float(output_size[1]) / img.size[1])
+        if scale <= 0.5:
+            img.draft(img.mode, (int(img.size[0] * scale) + 1,
+                                 int(img.size[1] * scale) + 1))
+
     live_area = (0, 0, img.size[0] - 1, img.size[1] - 1)
     live_size = (live_area[2] - live_area[0], live_area[3] - live_area[1])
 
@@ -74,8 +211,144 @@ def crop_to_fit(img, output_size):
 
     outputImage = img.crop((left_side, top_side, left_side + crop_width, top_side + crop_height))
 
+    # big crops are halved with the cheap BILINEAR filter until they
+    # are less than 2 * RESAMPLE_GAP times the output size, so that
+    # ANTIALIAS runs on a small image. PIL's BILINEAR only looks at
+    # the closest pixels, so it averages each 2x2 block only when the
+    # size is exactly halved: larger steps, or odd sizes, would skip
+    # rows and columns of the image and alias.
+    width, height = crop_width, crop_height
+    while width / 2 >= output_size[0] * RESAMPLE_GAP and \
+          height / 2 >= output_size[1] * RESAMPLE_GAP:
+        if width % 2 or height % 2:
+            width, height = width - width % 2, height - height % 2
+            outputImage = outputImage.crop((0, 0, width, height))
+
+        width, height = width / 2, height / 2
+        outputImage = outputImage.resize((width, height), Image.BILINEAR)
+
     # resize the image and return it
-    return outputImage.resize(output_size, 3)
+    return outputImage.resize(output_size, Image.ANTIALIAS)
+
+def render_picture(fullpath, width, height, crop, center, background,
+                   profile=None):
+    '''Does the actual work of picture(), returning the image data
+    encoded with the given profile dict. It lives at module level so
+    that it can also run within the worker processes of ImagePool.'''
+    img = Image.open(fullpath)
+
+    if crop:
+        img = crop_to_fit(img, (width, height))
+
+    if center:
+        old_img = img
+        img = Image.new('RGBA', (width, height), background)
+        ow, oh = old_img.size
+        left = (width - ow) / 2
+        top = (height - oh) / 2
+        img.paste(old_img, (left, top))
+
+    if profile is None:
+        profile = profiles['original']
+
+    return encode(img, profile)
+
+class ImagePool(object):
+    '''Runs the image transformations within worker processes, so
+    that they are spread across all the cores instead of holding the
+    request threads. At most queue_size transformations can be waiting
+    at once, further requests get a "503 Service Unavailable", and so
+    do the ones that wait more than timeout seconds for their image.'''
+
+    def __init__(self, workers, queue_size, timeout=30):
+        if not isinstance(workers, int) or workers < 1:
+            raise TypeError('ImagePool takes a positive integer as ' \
+                            'workers parameter, got %r.' % workers)
+
+        if not isinstance(queue_size, int) or queue_size < 1:
+            raise TypeError('ImagePool takes a positive integer as ' \
+                            'queue_size parameter, got %r.' % queue_size)
+
+        self.pool = multiprocessing.Pool(workers)
+        self.slots = threading.Semaphore(queue_size)
+        self.timeout = timeout
+
+    def run(self, function, *args):
+        if not self.slots.acquire(False):
+            raise cherrypy.HTTPError(503, 'There are too many images ' \
+                                     'waiting to be rendered.')
+        try:
+            result = self.pool.apply_async(function, args)
+        except:
+            self.slots.release()
+            raise
+
+        finished = True
+        try:
+            return result.get(self.timeout)
+        except TimeoutError:
+            # the worker is still busy with it, so its slot is only
+            # given back once it is done
+            finished = False
+            waiter = threading.Thread(target=self.release_when_done,
+                                      args=(result,))
+            waiter.setDaemon(True)
+            waiter.start()
+            raise cherrypy.HTTPError(503, 'The image took too long ' \
+                                     'to be rendered.')
+        finally:
+            if finished:
+                self.slots.release()
+
+    def release_when_done(self, result):
+        result.wait()
+        self.slots.release()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_pool():
+    '''Creates the ImagePool configured through the "image.workers",
+    "image.queue_size" and "image.timeout" settings, if "image.workers"
+    is set. It runs when the CherryPy engine starts, before the server
+    and monitor threads do, since forking a process which already runs
+    other threads can leave the workers deadlocked.'''
+    global _pool
+    workers = cherrypy.config.get('image.workers')
+    if not workers:
+        return
+
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            queue_size = cherrypy.config.get('image.queue_size', workers * 4)
+            timeout = cherrypy.config.get('image.timeout', 30)
+            _pool = ImagePool(workers, queue_size, timeout)
+    finally:
+        _pool_lock.release()
+
+def get_pool():
+    '''Returns the ImagePool created by start_pool, or None when there
+    is none, which means that the images are transformed within the
+    request threads.'''
+    return _pool
+
+def close_pool():
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    finally:
+        _pool_lock.release()
+
+cherrypy.engine.subscribe('start', start_pool)
+cherrypy.engine.subscribe('stop', close_pool)
 
 def picture(path,
             width,
@@ -83,7 +356,8 @@ def picture(path,
             crop=True,
             center=True,
             background=0xffffff,
-            base_path=None):
+            base_path=None,
+            profile=None):
 
     if not isinstance(path, basestring):
         raise TypeError('picture() takes a string as path parameter, got %r.' % path)
@@ -97,21 +371,207 @@ def picture(path,
     if not base_path:
         base_path = cherrypy.config['image.dir']
 
-    wished_size = width, height
-    img = Image.open(os.path.join(base_path, path))
+    profile = get_profile_name(profile)
+    args = (os.path.join(base_path, path), width, height,
+            crop, center, background)
+    if profile != 'original':
+        args += (profiles[profile],)
 
-    if crop:
-        img = crop_to_fit(img, (width, height))
+    pool = get_pool()
+    if pool is None:
+        data = render_picture(*args)
+    else:
+        data = pool.run(render_picture, *args)
 
-    if center:
-        old_img = img
-        img = Image.new('RGBA', (width, height), background)
-        ow, oh = old_img.size
-        left = (width - ow) / 2
-        top = (height - oh) / 2
-        img.paste(old_img, (left, top))
+    cherrypy.response.headers['Content-type'] = get_content_type(profile)
+    return data
 
-    sfile = StringIO.StringIO()
-    img.save(sfile, "JPEG", quality=100)
-    cherrypy.response.headers['Content-type'] = "image/jpeg"
-    return sfile.getvalue()
+class ImageIndex(object):
+    '''Keeps the path, modification time, file size, format, width and
+    height of the images within image_dir, so that they can be looked
+    up without opening the images. When index_path is given, the index
+    is saved there, and loaded back on the next run, so that update()
+    only has to read the images added or changed since.'''
+
+    fields = ('mtime', 'size', 'format', 'width', 'height')
+    fs = FileSystem()
+
+    def __init__(self, image_dir, index_path=None):
+        self.image_dir = image_dir
+        self.index_path = index_path
+        self.changed = False
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, path):
+        return path in self._images
+
+    def load(self):
+        if not self.index_path or not self.fs.exists(self.index_path):
+            return
+
+        index_file = self.fs.open_raw(self.index_path, 'rb')
+        try:
+            images = cPickle.load(index_file)
+        finally:
+            index_file.close()
+
+        self._lock.acquire()
+        try:
+            self._images = images
+            self.changed = False
+        finally:
+            self._lock.release()
+
+    def save(self):
+        if not self.index_path or not self.changed:
+            return
+
+        self._lock.acquire()
+        try:
+            images = dict(self._images)
+            self.changed = False
+        finally:
+            self._lock.release()
+
+        temporary_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+        index_file = self.fs.open_raw(temporary_path, 'wb')
+        try:
+            cPickle.dump(images, index_file, 2)
+        finally:
+            index_file.close()
+
+        self.fs.rename(temporary_path, self.index_path)
+
+    def read(self, path, info):
+        '''Returns the entry for the given image, only its header is
+        read.'''
+        img = Image.open(self.fs.join(self.image_dir, path))
+        return (info.st_mtime, info.st_size, img.format) + img.size
+
+    def update(self):
+        '''Indexes the images added or changed since the last update,
+        and forgets the removed ones. Returns how many images were
+        added, changed or removed.'''
+        found = {}
+        for full_path in self.fs.locate(self.image_dir, '*'):
+            extension = os.path.splitext(full_path)[1].lower()
+            if extension in IMAGE_EXTENSIONS:
+                path = os.path.relpath(full_path, self.image_dir)
+                try:
+                    found[path] = self.fs.stat(full_path)
+                except OSError:
+                    # dangling symlinks, or removed meanwhile
+                    continue
+
+        updated = {}
+        for path, info in found.items():
+            entry = self._images.get(path)
+            if entry is None or entry[:2] != (info.st_mtime, info.st_size):
+                try:
+                    updated[path] = self.read(path, info)
+                except IOError:
+                    continue
+
+        self._lock.acquire()
+        try:
+            removed = [path for path in self._images if path not in found]
+            for path in removed:
+                del self._images[path]
+
+            self._images.update(updated)
+            if updated or removed:
+                self.changed = True
+        finally:
+            self._lock.release()
+
+        return len(updated) + len(removed)
+
+    def get(self, path):
+        '''Returns a dict with the path, mtime, size, format, width and
+        height of the given image, or None if it is not an image. The
+        image is stat()ed on each call, so that the ones added, changed
+        or removed since they were indexed are indexed again on the
+        way.'''
+        path = os.path.normpath(path.lstrip('/'))
+        try:
+            info = self.fs.stat(self.fs.join(self.image_dir, path))
+            entry = self._images.get(path)
+            if entry is None or entry[:2] != (info.st_mtime, info.st_size):
+                entry = self.read(path, info)
+        except (IOError, OSError):
+            entry = None
+
+        self._lock.acquire()
+        try:
+            if entry is None:
+                if self._images.pop(path, None) is not None:
+                    self.changed = True
+                return None
+
+            if self._images.get(path) != entry:
+                self._images[path] = entry
+                self.changed = True
+        finally:
+            self._lock.release()
+
+        info = dict(zip(self.fields, entry))
+        info['path'] = path
+        return info
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    '''Returns the ImageIndex of "image.dir", saved at the "image.index"
+    setting when it is set, and saved again when the server stops. When
+    the engine did not build it on start, it is only loaded when first
+    used, and the images are indexed as they are looked up.'''
+    global _index
+    _index_lock.acquire()
+    try:
+        if _index is None:
+            index = ImageIndex(cherrypy.config['image.dir'],
+                               cherrypy.config.get('image.index'))
+            index.load()
+            cherrypy.engine.subscribe('stop', index.save)
+            _index = index
+    finally:
+        _index_lock.release()
+
+    return _index
+
+def start_index():
+    '''Indexes the images within "image.dir" when the CherryPy engine
+    starts, so that the first requests do not have to. It only does so
+    when the index is saved at "image.index", so that each start only
+    reads the images changed since, otherwise the images are indexed
+    as they are looked up.'''
+    if not cherrypy.config.get('image.dir') or \
+           not cherrypy.config.get('image.index'):
+        return
+
+    index = get_index()
+    index.update()
+    index.save()
+
+def clear_index():
+    global _index
+    _index_lock.acquire()
+    try:
+        if _index is not None:
+            cherrypy.engine.unsubscribe('stop', _index.save)
+            _index = None
+    finally:
+        _index_lock.release()
+
+def image_info(path):
+    '''Returns the path, mtime, size, format, width and height of the
+    given image, relative to "image.dir", as a dict, or None if there
+    is no such image.'''
+    return get_index().get(path)
+
+cherrypy.engine.subscribe('start', start_index)
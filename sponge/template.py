@@ -17,58 +17,340 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
+import urllib
+import StringIO
+import threading
 import cherrypy
+
+from hashlib import md5
+from cherrypy.lib import cptools
+from genshi.core import Markup
 from genshi.template import TemplateLoader
 
+from sponge.cache import LRUCache
+from sponge.controller import routes_index
+
+# how many compiled templates each loader keeps in memory, can be
+# overriden through the "template.cache_size" setting
+CACHE_SIZE = 100
+
+# how many rendered pages are kept by render_html's output cache
+OUTPUT_CACHE_SIZE = 500
+
+# how many rendered fragments are kept by the "cache" template helper
+FRAGMENT_CACHE_SIZE = 500
+
+# compression level of the pages sent gzipped by render_html
+GZIP_LEVEL = 6
+
+# how many bytes stream_html gathers before sending them
+STREAM_CHUNK_SIZE = 8192
+
+_loaders = {}
+_loaders_lock = threading.Lock()
+
+output_cache = LRUCache(OUTPUT_CACHE_SIZE)
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+def get_loader(template_path, auto_reload=True):
+    '''Returns the TemplateLoader for the given template directory,
+    creating it only in the first call, so that the compiled
+    templates are shared by all requests within the process.
+
+    When auto_reload is False the loader never checks if the
+    template files have changed on disk.'''
+    key = template_path, auto_reload
+    _loaders_lock.acquire()
+    try:
+        loader = _loaders.get(key)
+        if loader is None:
+            cache_size = cherrypy.config.get('template.cache_size',
+                                             CACHE_SIZE)
+            loader = TemplateLoader(template_path,
+                                    auto_reload=auto_reload,
+                                    max_cache_size=cache_size)
+            _loaders[key] = loader
+    finally:
+        _loaders_lock.release()
+
+    return loader
+
+def clear_loaders():
+    '''Forgets all the loaders, and the templates compiled by them.'''
+    _loaders_lock.acquire()
+    try:
+        _loaders.clear()
+    finally:
+        _loaders_lock.release()
+
 def make_url(url):
-    if not isinstance(url, basestring):
-        raise TypeError('sponge.template.make_url ' \
-                        'takes a string as param, got %r.' % url)
-    if url.startswith('/'):
-        url = url[1:]
+    return bind_make_url()(url)
 
+def bind_make_url():
+    '''Returns a make_url function bound to the base url of the
+    current request, so that a template calling it many times does
+    not look the base up on each call.'''
     base = cherrypy.request.base
     if base.endswith('/'):
         base = base[:-1]
 
-    return "%s/%s" % (base, url)
+    def make_url(url):
+        if not isinstance(url, basestring):
+            raise TypeError('sponge.template.make_url ' \
+                            'takes a string as param, got %r.' % url)
+        if url.startswith('/'):
+            url = url[1:]
+
+        return "%s/%s" % (base, url)
 
-def render_html(filename, context=None, template_path=None):
+    return make_url
+
+def url_for(name, **params):
+    '''Builds the full url to the route registered with the given
+    name, filling its variables with the given params. The params that
+    are not route variables go to the query string.'''
+    try:
+        parts = routes_index[name]
+    except KeyError:
+        raise LookupError('sponge.template.url_for could not ' \
+                          'find a route named %r.' % name)
+
+    path = []
+    for is_variable, text in parts:
+        if not is_variable:
+            path.append(text)
+            continue
+
+        try:
+            value = params.pop(text)
+        except KeyError:
+            raise TypeError('sponge.template.url_for needs the ' \
+                            'param %r to build the route %r.' % (text, name))
+
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        path.append(urllib.quote(str(value)))
+
+    url = "/".join(path)
+    if params:
+        url = "%s?%s" % (url, urllib.urlencode(sorted(params.items())))
+
+    return make_url(url)
+
+def image_info(path):
+    '''Returns the path, mtime, size, format, width and height of the
+    given image, relative to "image.dir", from the image index.'''
+    # PIL is only needed by the projects which use images
+    from sponge.helpers.image import image_info
+    return image_info(path)
+
+def _prepare(function_name, filename, context, template_path):
     if context is None:
         context = {}
 
     if not isinstance(filename, basestring):
-        raise TypeError('sponge.template.render_html ' \
-                        'takes a string as filename param, got %r.' % filename)
+        raise TypeError('sponge.template.%s ' \
+                        'takes a string as filename param, got %r.' % \
+                        (function_name, filename))
 
     if not len(filename):
-        raise TypeError('sponge.template.render_html ' \
-                        'filename param can not be empty.')
+        raise TypeError('sponge.template.%s ' \
+                        'filename param can not be empty.' % function_name)
 
     if not isinstance(context, dict):
-        raise TypeError('sponge.template.render_html ' \
-                        'takes a dict as context param, got %r.' % context)
+        raise TypeError('sponge.template.%s ' \
+                        'takes a dict as context param, got %r.' % \
+                        (function_name, context))
 
-    if 'make_url' in context.keys():
-        msg = 'The key "make_url" is already in ' \
-              'template context as: %r' % make_url
-        raise KeyError(msg)
+    for key, helper in (('make_url', make_url),
+                        ('url_for', url_for),
+                        ('image_info', image_info),
+                        ('cache', FragmentCache)):
+        if key in context.keys():
+            msg = 'The key "%s" is already in ' \
+                  'template context as: %r' % (key, helper)
+            raise KeyError(msg)
 
     if template_path is None:
         try:
             template_path = cherrypy.config['template.dir']
         except KeyError:
             raise LookupError('You must configure "template.dir" string in ' \
-                              'CherryPy or pass template_path param to render_html')
+                              'CherryPy or pass template_path param to %s' % \
+                              function_name)
 
     elif not isinstance(template_path, basestring):
-        raise TypeError('sponge.template.render_html ' \
-                        'takes a string as template_path param, got %r.' % template_path)
+        raise TypeError('sponge.template.%s ' \
+                        'takes a string as template_path param, got %r.' % \
+                        (function_name, template_path))
+
+    context['make_url'] = bind_make_url()
+    context['url_for'] = url_for
+    context['image_info'] = image_info
+    context['cache'] = FragmentCache(template_path)
+    return context, template_path
 
-    context['make_url'] = make_url
-    loader = TemplateLoader(template_path,
-                            auto_reload=True)
+def _generate(filename, context, template_path):
+    auto_reload = cherrypy.config.get('template.auto_reload', True)
+    loader = get_loader(template_path, auto_reload)
     template = loader.load(filename)
-    generator = template.generate(**context)
-    return generator.render('html', doctype='html')
+    return template.generate(**context)
+
+class FragmentCache(object):
+    '''Available as "cache" within the templates rendered by Sponge,
+    keeps rendered fragments in memory for ttl seconds, so that they
+    are reused across requests and users::
+
+        ${cache('sidebar', 300, 'sidebar.html', items=items)}
+
+    The source can be a template filename, rendered with the given
+    data, or a function returning html, called with it.'''
+
+    def __init__(self, template_path):
+        self.template_path = template_path
+
+    def __call__(self, key, ttl, source, **data):
+        cache_key = self.template_path, cherrypy.request.base, key
+        fragment = fragment_cache.get(cache_key)
+        if fragment is None:
+            if isinstance(source, basestring):
+                context, template_path = _prepare('cache', source, data,
+                                                  self.template_path)
+                generator = _generate(source, context, template_path)
+                fragment = generator.render('html', encoding=None)
+            else:
+                fragment = source(**data)
+
+            fragment = Markup(fragment)
+            fragment_cache.set(cache_key, fragment, ttl)
+
+        return fragment
+
+def invalidate_fragment(key=None):
+    '''Removes fragments from the "cache" template helper. With no
+    arguments all the fragments are removed, otherwise only the ones
+    with the given key.'''
+    return fragment_cache.delete_if(lambda cached: key is None or \
+                                    cached[2] == key)
+
+def _render_page(filename, context, template_path):
+    generator = _generate(filename, context, template_path)
+    return {'html': generator.render('html', doctype='html')}
+
+def accepts_gzip():
+    '''Returns True when the current request accepts gzip encoded
+    responses.'''
+    for encoding in cherrypy.request.headers.elements('Accept-Encoding'):
+        if encoding.value in ('gzip', 'x-gzip') and encoding.qvalue > 0:
+            return True
+
+    return False
+
+def compress(data, level=GZIP_LEVEL):
+    sfile = StringIO.StringIO()
+    zfile = gzip.GzipFile(mode='wb', compresslevel=level, fileobj=sfile)
+    zfile.write(data)
+    zfile.close()
+    return sfile.getvalue()
+
+def render_html(filename, context=None, template_path=None,
+                cache_key=None, ttl=None, etag=False, gzipped=None):
+    '''Renders the given template with the given context.
+
+    When cache_key is given, it must be a function that takes the
+    context and returns a hashable key. The rendered page is then kept
+    in memory for ttl seconds, or until invalidate_html is called, and
+    reused by any call to render_html with the same template and
+    key.
+
+    When etag is True, the response gets an ETag header with the hash
+    of the page, and requests whose If-None-Match header matches it
+    get a "304 Not Modified" response instead.
+
+    When gzipped is True, which defaults to the "template.gzip"
+    setting, the page is sent gzip compressed to the clients that
+    accept it. Cached pages are compressed only once.'''
+    context, template_path = _prepare('render_html', filename,
+                                      context, template_path)
+    if cache_key is None:
+        page = _render_page(filename, context, template_path)
+    else:
+        key = (template_path, filename,
+               cherrypy.request.base, cache_key(context))
+        page = output_cache.get(key)
+        if page is None:
+            page = _render_page(filename, context, template_path)
+            output_cache.set(key, page, ttl)
+
+    if gzipped is None:
+        gzipped = cherrypy.config.get('template.gzip', False)
+
+    body = page['html']
+    if gzipped:
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        gzipped = accepts_gzip()
+
+    if gzipped:
+        if 'gzip' not in page:
+            page['gzip'] = compress(page['html'])
+
+        cherrypy.response.headers['Content-Encoding'] = 'gzip'
+        body = page['gzip']
+
+    if etag:
+        # cached pages are hashed only once
+        if 'etag' not in page:
+            page['etag'] = md5(page['html']).hexdigest()
+
+        # each encoding of the page must have its own ETag
+        if gzipped:
+            cherrypy.response.headers['ETag'] = '"%s-gzip"' % page['etag']
+        else:
+            cherrypy.response.headers['ETag'] = '"%s"' % page['etag']
+
+        cptools.validate_etags()
+
+    return body
+
+def invalidate_html(filename=None, key=None):
+    '''Removes pages from render_html's output cache.
+    With no arguments the whole cache is cleared, otherwise only the
+    pages rendered from the given template, and, if the key is also
+    given, only the ones whose cache_key returned it.'''
+    def matches(cached):
+        if filename is not None and cached[1] != filename:
+            return False
+        if key is not None and cached[3] != key:
+            return False
+        return True
+
+    return output_cache.delete_if(matches)
+
+def stream_html(filename, context=None, template_path=None):
+    '''Works like render_html, but returns an iterator over the
+    rendered chunks, so that CherryPy starts sending the page before
+    it is completely rendered.'''
+    context, template_path = _prepare('stream_html', filename,
+                                      context, template_path)
+    generator = _generate(filename, context, template_path)
+    cherrypy.response.stream = True
+    return join_chunks(generator.serialize('html', doctype='html'))
+
+def join_chunks(stream, size=STREAM_CHUNK_SIZE, encoding='utf-8'):
+    '''Genshi serializes each markup event on its own, so its output
+    is gathered into encoded chunks of about size bytes, instead of
+    being sent as thousands of tiny writes.'''
+    chunk = []
+    length = 0
+    for text in stream:
+        chunk.append(text)
+        length += len(text)
+        if length >= size:
+            yield u''.join(chunk).encode(encoding)
+            chunk = []
+            length = 0
 
+    if chunk:
+        yield u''.join(chunk).encode(encoding)
@@ -18,8 +18,17 @@
 # License along with this program; if not, write to the
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
+import os
+import sys
+import Image
+import shutil
+import cherrypy
+import tempfile
+from StringIO import StringIO
 from sponge.bob import Bob
 
+images = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+
 def test_get_file_path():
     b = Bob()
     path = b.get_file_path()
@@ -27,3 +36,36 @@ def test_get_file_path():
     # ignoring the "c" of "pyc", if any
     path = path.rstrip("c")
     assert path.endswith('sponge/bob/__init__.py')
+
+def warm(cache_path, *sizes):
+    b = Bob()
+    b.configure = lambda: None
+    sys.stdout = StringIO()
+    try:
+        code = b.warm(cache_path, *sizes)
+        return code, sys.stdout.getvalue()
+    finally:
+        sys.stdout = sys.__stdout__
+
+def test_warm_renders_and_resumes():
+    cache_path = tempfile.mkdtemp()
+    cherrypy.config['image.dir'] = images
+    cherrypy.config['image.workers'] = 2
+    try:
+        code, output = warm(cache_path, '64x48', '32x32')
+        assert code == 0, 'Expected exit code 0, got %r' % code
+        assert output.endswith('rendered 4 images, 0 were already ' \
+                               'cached, 0 failed\n'), output
+
+        img = Image.open(os.path.join(cache_path, 'crop', '64x48', '2823371.jpg'))
+        assert img.size == (64, 48), 'Expected size 64x48, got %rx%r' % img.size
+
+        os.remove(os.path.join(cache_path, 'crop', '32x32', '2848058.jpg'))
+        code, output = warm(cache_path, '64x48', '32x32')
+        assert output.endswith('rendered 1 images, 3 were already ' \
+                               'cached, 0 failed\n'), output
+        assert os.path.exists(os.path.join(cache_path, 'crop', '32x32', '2848058.jpg'))
+    finally:
+        del cherrypy.config['image.dir']
+        del cherrypy.config['image.workers']
+        shutil.rmtree(cache_path)
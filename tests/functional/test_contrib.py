@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+import Image
+import shutil
+import cherrypy
+import tempfile
+from StringIO import StringIO
+from nose.tools import assert_equals
+from sponge.contrib import controllers
+from sponge.helpers import image
+
+images = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+
+def request(handler, *args, **headers):
+    image_dir = headers.pop('image_dir', images)
+    cherrypy.request.headers.clear()
+    cherrypy.request.headers.update(headers)
+    cherrypy.request.method = 'GET'
+    cherrypy.response.headers.clear()
+    cherrypy.response.status = 200
+    if hasattr(cherrypy.response, 'ETag'):
+        del cherrypy.response.ETag
+
+    cherrypy.config['image.dir'] = image_dir
+    try:
+        return handler(*args)
+    finally:
+        del cherrypy.config['image.dir']
+        cherrypy.request.headers.clear()
+
+def test_image_handler_sends_validators():
+    handler = controllers.ImageHandler()
+    got = request(handler, 'crop', '64x48', '2823371.jpg')
+    assert_equals(Image.open(StringIO(got)).size, (64, 48))
+
+    headers = cherrypy.response.headers
+    mtime = os.stat(os.path.join(images, '2823371.jpg')).st_mtime
+    assert_equals(headers['Last-Modified'], cherrypy.lib.httputil.HTTPDate(mtime))
+    assert_equals(headers['Cache-Control'], 'public, max-age=31536000')
+    assert headers['ETag'].startswith('"'), headers['ETag']
+
+def test_image_handler_etag_depends_on_variant():
+    handler = controllers.ImageHandler()
+    request(handler, 'crop', '64x48', '2823371.jpg')
+    first = cherrypy.response.headers['ETag']
+    request(handler, 'crop', '32x32', '2823371.jpg')
+    second = cherrypy.response.headers['ETag']
+    request(handler, 'crop', '64x48', '2823371.jpg')
+    assert first != second, 'Each variant should have its own ETag'
+    assert_equals(cherrypy.response.headers['ETag'], first)
+
+def test_image_handler_answers_not_modified_without_rendering():
+    handler = controllers.ImageHandler(max_age=60)
+    request(handler, 'crop', '64x48', '2823371.jpg')
+    etag = cherrypy.response.headers['ETag']
+    last_modified = cherrypy.response.headers['Last-Modified']
+
+    old_picture = controllers.picture
+    controllers.picture = None
+    try:
+        for headers in ({'If-None-Match': etag},
+                        {'If-Modified-Since': last_modified}):
+            try:
+                request(handler, 'crop', '64x48', '2823371.jpg', **headers)
+                assert False, 'Expected a 304 redirect for %r' % headers
+            except cherrypy.HTTPRedirect, e:
+                assert_equals(e.status, 304)
+
+            assert_equals(cherrypy.response.headers['Cache-Control'],
+                          'public, max-age=60')
+    finally:
+        controllers.picture = old_picture
+        if hasattr(cherrypy.response, 'ETag'):
+            del cherrypy.response.ETag
+
+def test_image_handler_sends_no_validators_for_missing_images():
+    handler = controllers.ImageHandler()
+    request(handler, 'missing.jpg')
+    assert 'ETag' not in cherrypy.response.headers
+    assert_equals(cherrypy.response.status, 404)
+    if hasattr(cherrypy.response, 'ETag'):
+        del cherrypy.response.ETag
+
+def test_srcset_renders_missing_variants_in_background():
+    cache_path = tempfile.mkdtemp()
+    cherrypy.config['image.dir'] = images
+    cherrypy.request.base = 'http://localhost'
+    try:
+        handler = controllers.ImageHandler(cache_at=cache_path,
+                                           base_url='/images')
+        got = handler.srcset('2823371.jpg', [150, 300])
+        assert_equals(got, 'http://localhost/images/crop/150x148/2823371.jpg 150w, '
+                      'http://localhost/images/crop/300x296/2823371.jpg 300w')
+
+        controllers.get_renderer().join()
+        img = Image.open(os.path.join(cache_path, 'crop', '300x296', '2823371.jpg'))
+        assert_equals(img.size, (300, 296))
+    finally:
+        image.clear_index()
+        del cherrypy.config['image.dir']
+        shutil.rmtree(cache_path)
+
+def test_image_handler_renders_again_when_source_changes():
+    image_dir = tempfile.mkdtemp()
+    cache_path = tempfile.mkdtemp()
+    source = os.path.join(image_dir, 'a.png')
+    try:
+        Image.new('RGB', (80, 60), (255, 0, 0)).save(source)
+        handlers = [controllers.ImageHandler(cache_at=cache_path),
+                    controllers.ImageHandler(memory_cache_size=1024 * 1024)]
+        firsts = []
+        for handler in handlers:
+            got = request(handler, 'crop', '40x30', 'a.png', image_dir=image_dir)
+            firsts.append((got, cherrypy.response.headers['ETag']))
+
+        Image.new('RGB', (80, 60), (0, 0, 255)).save(source)
+        mtime = os.stat(source).st_mtime + 10
+        os.utime(source, (mtime, mtime))
+
+        for handler, (first, etag) in zip(handlers, firsts):
+            got = request(handler, 'crop', '40x30', 'a.png', image_dir=image_dir)
+            if not isinstance(got, str):
+                got = ''.join(got)
+
+            assert got != first, 'The cached variant should be rendered again'
+            assert cherrypy.response.headers['ETag'] != etag, 'The ETag should change'
+            red, green, blue = Image.open(StringIO(got)).convert('RGB').getpixel((20, 15))
+            assert blue > 200 and red < 50, 'Expected the new blue image, got %r' % ((red, green, blue), )
+    finally:
+        if hasattr(cherrypy.response, 'ETag'):
+            del cherrypy.response.ETag
+        shutil.rmtree(image_dir)
+        shutil.rmtree(cache_path)
+
+def test_image_handler_renders_again_when_source_is_replaced_by_older_one():
+    image_dir = tempfile.mkdtemp()
+    cache_path = tempfile.mkdtemp()
+    source = os.path.join(image_dir, 'a.png')
+    try:
+        Image.new('RGB', (80, 60), (255, 0, 0)).save(source)
+        handler = controllers.ImageHandler(cache_at=cache_path)
+        request(handler, 'crop', '40x30', 'a.png', image_dir=image_dir)
+
+        # like "rsync -a" or "cp -p" would, keeping an older mtime
+        Image.new('RGB', (80, 60), (0, 0, 255)).save(source)
+        mtime = os.stat(source).st_mtime - 3600
+        os.utime(source, (mtime, mtime))
+
+        for attempt in ('rendered', 'cached'):
+            got = request(handler, 'crop', '40x30', 'a.png', image_dir=image_dir)
+            if not isinstance(got, str):
+                got = ''.join(got)
+
+            red, green, blue = Image.open(StringIO(got)).convert('RGB').getpixel((20, 15))
+            assert blue > 200 and red < 50, 'Expected the %s blue image, got %r' % (attempt, (red, green, blue))
+    finally:
+        if hasattr(cherrypy.response, 'ETag'):
+            del cherrypy.response.ETag
+        shutil.rmtree(image_dir)
+        shutil.rmtree(cache_path)
+
+def test_image_handler_sends_no_validators_for_broken_images():
+    image_dir = tempfile.mkdtemp()
+    try:
+        open(os.path.join(image_dir, 'broken.png'), 'w').write('not an image')
+        handler = controllers.ImageHandler()
+        got = request(handler, 'broken.png', image_dir=image_dir)
+
+        assert isinstance(got, unicode), 'Expected an error, got %r' % got
+        assert_equals(cherrypy.response.status, 404)
+        for name in ('ETag', 'Last-Modified', 'Cache-Control'):
+            assert name not in cherrypy.response.headers, \
+                   'The %s header should not be sent' % name
+    finally:
+        if hasattr(cherrypy.response, 'ETag'):
+            del cherrypy.response.ETag
+        shutil.rmtree(image_dir)
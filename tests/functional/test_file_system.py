@@ -19,6 +19,8 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
+import os
+import tempfile
 from os.path import abspath, dirname, join, split
 from nose.tools import assert_equals
 from sponge.core.io import FileSystem
@@ -93,3 +95,38 @@ def test_open_raw_non_abspath():
 def test_open_raw_abspath():
     fs = FileSystem()
     assert fs.open_raw(abspath('./tests/functional/data/some.txt'), 'r').read() == 'some text here!\n'
+
+def test_rename_replaces_destination():
+    fs = FileSystem()
+    path = tempfile.mkdtemp()
+    try:
+        fs.open_raw(join(path, 'old.txt'), 'w').write('new')
+        fs.open_raw(join(path, 'new.txt'), 'w').write('old')
+        fs.rename(join(path, 'old.txt'), join(path, 'new.txt'))
+        assert not fs.exists(join(path, 'old.txt'))
+        assert_equals(fs.open_raw(join(path, 'new.txt'), 'r').read(), 'new')
+    finally:
+        os.remove(join(path, 'new.txt'))
+        os.rmdir(path)
+
+def test_utime_sets_modification_time():
+    fs = FileSystem()
+    path = tempfile.mkdtemp()
+    try:
+        fs.open_raw(join(path, 'file.txt'), 'w').write('data')
+        fs.utime(join(path, 'file.txt'), 1000000000)
+        assert_equals(fs.stat(join(path, 'file.txt')).st_mtime, 1000000000)
+    finally:
+        os.remove(join(path, 'file.txt'))
+        os.rmdir(path)
+
+def test_remove_ignores_missing_files():
+    fs = FileSystem()
+    path = tempfile.mkdtemp()
+    try:
+        fs.open_raw(join(path, 'file.txt'), 'w').write('data')
+        fs.remove(join(path, 'file.txt'))
+        assert not fs.exists(join(path, 'file.txt'))
+        fs.remove(join(path, 'file.txt'))
+    finally:
+        os.rmdir(path)
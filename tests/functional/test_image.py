@@ -18,13 +18,217 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 import os
+import Image
+import ImageStat
+import shutil
 import cherrypy
+import tempfile
+from StringIO import StringIO
 from sponge.helpers import image
 
 images = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
 
 def test_jpeg():
     cherrypy.config['image.dir'] = images
-    got = image.jpeg('2823371.jpg')
-    assert isinstance(got, basestring), 'Expected a string, got %r' % got
+    got = ''.join(image.jpeg('2823371.jpg'))
+    expected = open(os.path.join(images, '2823371.jpg'), 'rb').read()
+    assert got == expected, 'JPEG files should be sent as they are'
 
+    headers = cherrypy.response.headers
+    assert headers['Content-Type'] == 'image/jpeg'
+    assert headers['Content-Length'] == len(expected)
+    assert 'Last-Modified' in headers
+
+
+def test_jpeg_encodes_other_formats():
+    path = tempfile.mkdtemp()
+    try:
+        Image.new('RGB', (40, 30), 0xff0000).save(os.path.join(path, 'red.png'))
+        got = image.jpeg('red.png', base_path=path)
+        assert isinstance(got, str), 'Expected a string, got %r' % got
+
+        img = Image.open(StringIO(got))
+        assert img.format == 'JPEG', 'Expected a JPEG, got %r' % img.format
+        assert img.size == (40, 30), 'Expected size 40x30, got %rx%r' % img.size
+    finally:
+        shutil.rmtree(path)
+
+def test_picture_within_image_pool():
+    cherrypy.config['image.workers'] = 1
+    try:
+        image.start_pool()
+        assert image.get_pool() is not None, 'Expected a pool'
+        got = image.picture('2823371.jpg', 64, 48, base_path=images)
+        img = Image.open(StringIO(got))
+        assert img.size == (64, 48), 'Expected size 64x48, got %rx%r' % img.size
+    finally:
+        image.close_pool()
+        del cherrypy.config['image.workers']
+
+def test_crop_to_fit_does_not_alias_fine_detail():
+    # one white column out of four, which average 63.75
+    img = Image.new('L', (3000, 3000))
+    img.putdata([255, 0, 0, 0] * 750 * 3000)
+
+    got = ImageStat.Stat(image.crop_to_fit(img, (100, 100)))
+    assert abs(got.mean[0] - 63.75) < 3, 'Expected a mean of 63.75, got %r' % got.mean[0]
+    assert got.stddev[0] < 5, 'Expected an even gray, got a stddev of %r' % got.stddev[0]
+
+def test_crop_to_fit_decodes_large_jpegs_in_draft_mode():
+    img = Image.open(os.path.join(images, '2823371.jpg'))
+    got = image.crop_to_fit(img, (100, 100))
+    assert got.size == (100, 100), 'Expected size 100x100, got %rx%r' % got.size
+    assert img.size == (188, 186), \
+           'Expected the JPEG to be decoded at 1/4 of its size, got %rx%r' % img.size
+
+def test_crop_to_fit_does_not_draft_below_output_size():
+    img = Image.open(os.path.join(images, '2823371.jpg'))
+    got = image.crop_to_fit(img, (400, 300))
+    assert got.size == (400, 300), 'Expected size 400x300, got %rx%r' % got.size
+    assert img.size == (750, 741), \
+           'Expected the JPEG to be fully decoded, got %rx%r' % img.size
+
+def test_jpeg_reencodes_jpeg_files_with_other_profiles():
+    got = image.jpeg('2823371.jpg', base_path=images, profile='web')
+    assert isinstance(got, str), 'Expected a string, got %r' % got
+
+    original = open(os.path.join(images, '2823371.jpg'), 'rb').read()
+    assert len(got) < len(original), \
+           'Expected the web profile to be smaller than the original'
+
+    img = Image.open(StringIO(got))
+    assert img.format == 'JPEG', 'Expected a JPEG, got %r' % img.format
+    assert img.info.get('progressive'), 'Expected a progressive JPEG'
+
+def test_picture_with_png_profile():
+    got = image.picture('2823371.jpg', 64, 48, base_path=images,
+                        profile='png')
+    img = Image.open(StringIO(got))
+    assert img.format == 'PNG', 'Expected a PNG, got %r' % img.format
+    assert img.size == (64, 48), 'Expected size 64x48, got %rx%r' % img.size
+    assert cherrypy.response.headers['Content-type'] == 'image/png'
+
+def test_image_index_reads_images_once():
+    path = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(path, 'sub'))
+        Image.new('RGB', (40, 30)).save(os.path.join(path, 'sub', 'red.png'))
+        Image.new('RGB', (20, 10)).save(os.path.join(path, 'blue.JPG'), 'JPEG')
+        open(os.path.join(path, 'notes.txt'), 'w').write('not an image')
+
+        index_path = os.path.join(path, 'images.index')
+        index = image.ImageIndex(path, index_path)
+        assert index.update() == 2, 'Expected 2 images to be indexed'
+        index.save()
+
+        info = index.get('sub/red.png')
+        assert info['format'] == 'PNG', 'Expected a PNG, got %r' % info['format']
+        assert (info['width'], info['height']) == (40, 30), info
+        assert info['path'] == 'sub/red.png', info
+        assert index.get('/blue.JPG')['width'] == 20
+        assert index.get('missing.png') is None
+
+        index = image.ImageIndex(path, index_path)
+        index.load()
+        index.read = None
+        assert len(index) == 2, 'Expected the index to be loaded back'
+        assert index.update() == 0, 'Expected no image to be read again'
+
+        os.remove(os.path.join(path, 'blue.JPG'))
+        assert index.update() == 1, 'Expected the removed image to be forgotten'
+        assert 'blue.JPG' not in index
+    finally:
+        shutil.rmtree(path)
+
+def test_image_index_indexes_new_images_on_lookup():
+    path = tempfile.mkdtemp()
+    try:
+        index = image.ImageIndex(path)
+        index.update()
+        Image.new('RGB', (40, 30)).save(os.path.join(path, 'late.png'))
+        assert index.get('late.png')['height'] == 30
+        assert 'late.png' in index
+    finally:
+        shutil.rmtree(path)
+
+def test_image_index_notices_replaced_and_removed_images():
+    path = tempfile.mkdtemp()
+    try:
+        index = image.ImageIndex(path)
+        Image.new('RGB', (40, 30)).save(os.path.join(path, 'dog.png'))
+        index.update()
+        assert index.get('dog.png')['width'] == 40
+
+        Image.new('RGB', (80, 30)).save(os.path.join(path, 'dog.png'))
+        mtime = os.stat(os.path.join(path, 'dog.png')).st_mtime + 10
+        os.utime(os.path.join(path, 'dog.png'), (mtime, mtime))
+        assert index.get('dog.png')['width'] == 80, 'Expected the new width'
+
+        os.remove(os.path.join(path, 'dog.png'))
+        assert index.get('dog.png') is None, 'Expected the removed image to be forgotten'
+        assert 'dog.png' not in index
+    finally:
+        shutil.rmtree(path)
+
+def test_image_index_skips_dangling_symlinks():
+    path = tempfile.mkdtemp()
+    try:
+        Image.new('RGB', (40, 30)).save(os.path.join(path, 'dog.png'))
+        os.symlink(os.path.join(path, 'missing.png'), os.path.join(path, 'gone.png'))
+        index = image.ImageIndex(path)
+        assert index.update() == 1, 'Expected only the existing image to be indexed'
+        assert 'gone.png' not in index
+    finally:
+        shutil.rmtree(path)
+
+def test_start_index_indexes_images_when_engine_starts():
+    index_path = tempfile.mktemp()
+    cherrypy.config['image.dir'] = images
+    cherrypy.config['image.index'] = index_path
+    try:
+        image.start_index()
+        assert '2823371.jpg' in image.get_index(), 'Expected the images to be indexed'
+        assert os.path.exists(index_path), 'Expected the index to be saved'
+    finally:
+        image.clear_index()
+        del cherrypy.config['image.dir']
+        del cherrypy.config['image.index']
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+def test_start_index_needs_the_index_to_be_saved():
+    cherrypy.config['image.dir'] = images
+    try:
+        image.start_index()
+        assert len(image.get_index()) == 0, 'Expected no image to be read on start'
+    finally:
+        image.clear_index()
+        del cherrypy.config['image.dir']
+
+def test_image_info_uses_configured_index():
+    cherrypy.config['image.dir'] = images
+    try:
+        info = image.image_info('2823371.jpg')
+        assert (info['width'], info['height']) == (750, 741), info
+        assert image.get_index() is image.get_index()
+    finally:
+        image.clear_index()
+        del cherrypy.config['image.dir']
+
+def test_jpeg_leaves_originals_to_sendfile_header():
+    cherrypy.config['image.dir'] = images
+    cherrypy.config['image.sendfile'] = 'X-Accel-Redirect'
+    cherrypy.config['image.sendfile_prefix'] = '/internal'
+    cherrypy.response.headers.clear()
+    try:
+        got = image.jpeg('2823371.jpg')
+        headers = cherrypy.response.headers
+        assert got == '', 'Expected an empty body, got %d bytes' % len(got)
+        assert headers['X-Accel-Redirect'] == '/internal' + \
+               os.path.join(images, '2823371.jpg'), headers['X-Accel-Redirect']
+        assert headers['Content-Type'] == 'image/jpeg'
+        assert 'Last-Modified' in headers
+    finally:
+        del cherrypy.config['image.dir']
+        del cherrypy.config['image.sendfile']
+        del cherrypy.config['image.sendfile_prefix']
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import os
+from nose.tools import assert_equals
+from sponge import core, template
+
+templates = os.path.abspath(os.path.join(os.path.dirname(__file__), 'templates'))
+
+def test_precompile_templates():
+    template.clear_loaders()
+    try:
+        sp = core.SpongeConfig({}, core.ConfigValidator({}))
+        count, seconds = sp.precompile_templates(templates, False)
+        assert_equals(count, 3)
+
+        loader = template.get_loader(templates, False)
+        assert 'test1.html' in loader._cache, 'test1.html should be compiled'
+    finally:
+        template.clear_loaders()
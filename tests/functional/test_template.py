@@ -67,3 +67,58 @@ def test_render_html():
     got = template.render_html('test1.html', dict(title='foo', header='bar'), template_path=templates)
     assert '<title>My title: foo</title>' in got
     assert '<h1>My header: bar</h1>' in got
+
+def test_render_html_parses_template_only_once():
+    template.clear_loaders()
+    try:
+        template.render_html('test1.html', dict(title='foo', header='bar'), template_path=templates)
+        loader = template.get_loader(templates)
+        compiled = loader.load('test1.html')
+
+        got = template.render_html('test1.html', dict(title='baz', header='bar'), template_path=templates)
+        assert '<title>My title: baz</title>' in got
+        assert loader.load('test1.html') is compiled, 'The compiled template should be reused'
+    finally:
+        template.clear_loaders()
+
+def test_stream_html():
+    got = template.stream_html('test1.html', dict(title='foo', header='bar'), template_path=templates)
+    assert not isinstance(got, basestring), 'Expected an iterator, got %r' % got
+
+    chunks = list(got)
+    assert len(chunks) == 1, 'A small page should be sent in one chunk, got %r' % chunks
+
+    html = template.render_html('test1.html', dict(title='foo', header='bar'), template_path=templates)
+    assert ''.join(chunks) == html, 'Expected the same bytes as render_html'
+    cherrypy.response.stream = False
+
+def test_render_html_with_cache_key():
+    template.invalidate_html()
+    try:
+        key = lambda context: context['header']
+        got1 = template.render_html('test1.html', dict(title='foo', header='bar'),
+                                    template_path=templates, cache_key=key)
+        got2 = template.render_html('test1.html', dict(title='baz', header='bar'),
+                                    template_path=templates, cache_key=key)
+        assert got1 == got2, 'The second page should come from the cache'
+        assert '<title>My title: foo</title>' in got2
+
+        template.invalidate_html('test1.html')
+        got3 = template.render_html('test1.html', dict(title='baz', header='bar'),
+                                    template_path=templates, cache_key=key)
+        assert '<title>My title: baz</title>' in got3
+    finally:
+        template.invalidate_html()
+
+def test_render_html_with_cached_fragment():
+    template.invalidate_fragment()
+    try:
+        got1 = template.render_html('test2.html', dict(title='foo', items=['a', 'b']), template_path=templates)
+        got2 = template.render_html('test2.html', dict(title='bar', items=['c']), template_path=templates)
+        assert '<li>a</li>' in got1
+        assert '<li>b</li>' in got1
+        assert '<title>My title: bar</title>' in got2
+        assert '<li>a</li>' in got2, 'The fragment should come from the cache'
+        assert '<li>c</li>' not in got2, 'The fragment should come from the cache'
+    finally:
+        template.invalidate_fragment()
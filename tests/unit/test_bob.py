@@ -69,7 +69,7 @@ def test_run_fails_with_unknown_args():
     assert_raises(SystemExit, b.run)
     assert_equals(sys.stderr.getvalue(),
                   '\nargs is an invalid argument, choose one ' \
-                  'in create, go, start\n')
+                  'in create, go, start, warm\n')
     sys.stderr = sys.__stderr__
     mox.VerifyAll()
 
@@ -86,7 +86,7 @@ def test_run_fails_without_args():
     assert_raises(SystemExit, b.run)
     assert_equals(sys.stderr.getvalue(),
                   '\nmissing argument, choose one ' \
-                  'in create, go, start\n')
+                  'in create, go, start, warm\n')
     sys.stderr = sys.__stderr__
     mox.VerifyAll()
 
@@ -351,4 +351,117 @@ def test_bob_help():
                   "creating a new folder in current directory, named " \
                   "projectname\ngo start the cherrypy server using the " \
                   "configuration file settings.yml in current directory." \
-                  "\nstart <projectname> executes both bob create and bob go")
+                  "\nstart <projectname> executes both bob create and bob go" \
+                  "\nwarm <cachepath> [<width>x<height> ...] renders into " \
+                  "cachepath the images cropped to the given sizes, or to " \
+                  "the image-sizes setting, skipping the ones already there.")
+
+def test_run_calls_warm_with_arguments():
+    mox = Mox()
+
+    mock_parser = mox.CreateMockAnything()
+    mock_parser.parse_args().AndReturn(("options",
+                                        ['warm', '/cache', '200x100']))
+    b = bob.Bob(parser=mock_parser)
+    b.warm = mox.CreateMockAnything()
+    b.warm('/cache', '200x100')
+
+    mox.ReplayAll()
+    b.run()
+    mox.VerifyAll()
+
+def test_warm_fails_without_cache_path():
+    b = bob.Bob()
+    sys.stderr = StringIO()
+    try:
+        assert_raises(SystemExit, b.warm)
+        assert_equals(sys.stderr.getvalue(),
+                      '\nmissing cache path, try something like ' \
+                      '"bob warm /srv/images/cache 200x100"\n')
+    finally:
+        sys.stderr = sys.__stderr__
+
+def test_warm_fails_with_invalid_size():
+    mox = Mox()
+    b = bob.Bob()
+    b.configure = mox.CreateMockAnything()
+    b.configure()
+
+    mox.ReplayAll()
+    sys.stderr = StringIO()
+    try:
+        assert_raises(SystemExit, b.warm, '/cache', 'big')
+        assert_equals(sys.stderr.getvalue(),
+                      "\n'big' is not a size like 200x100\n")
+        mox.VerifyAll()
+    finally:
+        sys.stderr = sys.__stderr__
+
+def test_warm_fails_without_sizes():
+    mox = Mox()
+    b = bob.Bob()
+    b.configure = mox.CreateMockAnything()
+    b.configure()
+
+    mox.ReplayAll()
+    sys.stderr = StringIO()
+    try:
+        assert_raises(SystemExit, b.warm, '/cache')
+        assert_equals(sys.stderr.getvalue(),
+                      '\nmissing sizes, give them after the cache path ' \
+                      'or set image-sizes in settings.yml\n')
+        mox.VerifyAll()
+    finally:
+        sys.stderr = sys.__stderr__
+
+def test_get_warm_jobs_skips_cached_images():
+    mox = Mox()
+    b = bob.Bob()
+    b.fs = mox.CreateMockAnything()
+
+    handler = mox.CreateMockAnything()
+
+    b.fs.locate('/images', '*').AndReturn(['/images/b/dog.JPG',
+                                           '/images/notes.txt',
+                                           '/images/cat.png',
+                                           '/images/owl.png'])
+
+    handler.get_version('b/dog.JPG').AndReturn((1.0, 10))
+    handler.get_key('crop/200x100/b/dog.JPG', 'original'). \
+            AndReturn('crop/200x100/b/dog.JPG')
+    handler.get_cache_path('crop/200x100/b/dog.JPG'). \
+            AndReturn('/cache/crop/200x100/b/dog.JPG')
+    b.fs.exists('/cache/crop/200x100/b/dog.JPG').AndReturn(True)
+    handler.is_fresh('/cache/crop/200x100/b/dog.JPG', (1.0, 10)). \
+            AndReturn(True)
+
+    handler.get_version('cat.png').AndReturn((2.0, 20))
+    handler.get_key('crop/200x100/cat.png', 'original'). \
+            AndReturn('crop/200x100/cat.png')
+    handler.get_cache_path('crop/200x100/cat.png'). \
+            AndReturn('/cache/crop/200x100/cat.png')
+    b.fs.exists('/cache/crop/200x100/cat.png').AndReturn(False)
+
+    handler.get_version('owl.png').AndReturn((3.0, 30))
+    handler.get_key('crop/200x100/owl.png', 'original'). \
+            AndReturn('crop/200x100/owl.png')
+    handler.get_cache_path('crop/200x100/owl.png'). \
+            AndReturn('/cache/crop/200x100/owl.png')
+    b.fs.exists('/cache/crop/200x100/owl.png').AndReturn(True)
+    handler.is_fresh('/cache/crop/200x100/owl.png', (3.0, 30)). \
+            AndReturn(False)
+
+    mox.ReplayAll()
+    cherrypy.config['image.dir'] = '/images'
+    try:
+        jobs, cached = b.get_warm_jobs(handler, [(200, 100)])
+        assert_equals(cached, 1)
+        assert_equals(jobs, [('/images/cat.png', 200, 100,
+                              bob.profiles['original'],
+                              '/cache/crop/200x100/cat.png', (2.0, 20)),
+                             ('/images/owl.png', 200, 100,
+                              bob.profiles['original'],
+                              '/cache/crop/200x100/owl.png', (3.0, 30))])
+        mox.VerifyAll()
+    finally:
+        del cherrypy.config['image.dir']
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; -*-
+#
+# Copyright (C) 2009 Gabriel Falcão <gabriel@nacaolivre.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+import threading
+
+from mox import Mox
+from nose.tools import assert_equals
+from utils import assert_raises
+
+from sponge import cache
+
+def test_lru_cache_takes_positive_integer():
+    assert_raises(TypeError, cache.LRUCache, 0,
+                  exc_pattern=r'LRUCache takes a positive integer as ' \
+                  'max_entries parameter, got 0.')
+    assert_raises(TypeError, cache.LRUCache, 'ten',
+                  exc_pattern=r'LRUCache takes a positive integer as ' \
+                  'max_entries parameter, got \'ten\'.')
+
+def test_lru_cache_takes_positive_max_size():
+    assert_raises(TypeError, cache.LRUCache, 10, -1,
+                  exc_pattern=r'LRUCache takes a positive integer as ' \
+                  'max_size parameter, got -1.')
+
+def test_lru_cache_get_and_set():
+    lru = cache.LRUCache(10)
+    lru.set('key', 'value')
+    assert_equals(lru.get('key'), 'value')
+    assert_equals(lru.get('other-key'), None)
+    assert_equals(lru.get('other-key', 'default'), 'default')
+    assert 'key' in lru
+    assert_equals(len(lru), 1)
+
+def test_lru_cache_set_replaces_value():
+    lru = cache.LRUCache(10)
+    lru.set('key', 'value1')
+    lru.set('key', 'value2')
+    assert_equals(lru.get('key'), 'value2')
+    assert_equals(len(lru), 1)
+
+def test_lru_cache_forgets_least_recently_used():
+    lru = cache.LRUCache(2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.get('a')
+    lru.set('c', 3)
+
+    assert_equals(lru.get('a'), 1)
+    assert_equals(lru.get('b'), None)
+    assert_equals(lru.get('c'), 3)
+    assert_equals(len(lru), 2)
+
+def test_lru_cache_expires_items():
+    mox = Mox()
+    mox.StubOutWithMock(cache, 'time')
+
+    cache.time.time().AndReturn(100)
+    cache.time.time().AndReturn(109)
+    cache.time.time().AndReturn(110)
+
+    lru = cache.LRUCache(10)
+    mox.ReplayAll()
+    try:
+        lru.set('key', 'value', ttl=10)
+        assert_equals(lru.get('key'), 'value')
+        assert_equals(lru.get('key'), None)
+        assert_equals(len(lru), 0)
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_lru_cache_delete():
+    lru = cache.LRUCache(10)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.delete('a')
+    lru.delete('not-there')
+    assert_equals(lru.get('a'), None)
+    assert_equals(lru.get('b'), 2)
+
+def test_lru_cache_delete_if():
+    lru = cache.LRUCache(10)
+    lru.set(('index.html', 1), 'a')
+    lru.set(('index.html', 2), 'b')
+    lru.set(('about.html', 1), 'c')
+
+    removed = lru.delete_if(lambda key: key[0] == 'index.html')
+    assert_equals(removed, 2)
+    assert_equals(len(lru), 1)
+    assert_equals(lru.get(('about.html', 1)), 'c')
+
+def test_lru_cache_clear():
+    lru = cache.LRUCache(10)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.clear()
+    assert_equals(len(lru), 0)
+    lru.set('c', 3)
+    assert_equals(lru.get('c'), 3)
+
+def test_lru_cache_forgets_least_recently_used_when_too_big():
+    lru = cache.LRUCache(max_entries=None, max_size=10)
+    lru.set('a', '12345')
+    lru.set('b', '1234')
+    lru.get('a')
+    lru.set('c', '123')
+
+    assert_equals(lru.get('a'), '12345')
+    assert_equals(lru.get('b'), None)
+    assert_equals(lru.get('c'), '123')
+    assert_equals(lru.size, 8)
+
+def test_lru_cache_does_not_keep_items_bigger_than_max_size():
+    lru = cache.LRUCache(max_entries=None, max_size=10)
+    lru.set('a', '12345')
+    lru.set('b', '12345678901')
+
+    assert_equals(lru.get('a'), '12345')
+    assert_equals(lru.get('b'), None)
+    assert_equals(lru.size, 5)
+
+def test_lru_cache_stats():
+    lru = cache.LRUCache(max_entries=2)
+    lru.set('a', '12')
+    lru.set('b', '34')
+    lru.set('c', '56')
+    lru.get('b')
+    lru.get('a')
+
+    assert_equals(lru.stats(), {
+        'entries': 2,
+        'size': 0,
+        'hits': 1,
+        'misses': 1,
+        'evictions': 1,
+    })
+
+def test_disk_usage_takes_positive_max_size():
+    assert_raises(TypeError, cache.DiskUsage, 0,
+                  exc_pattern=r'DiskUsage takes a positive integer as ' \
+                  'max_size parameter, got 0.')
+
+def test_disk_usage_takes_known_policy():
+    assert_raises(ValueError, cache.DiskUsage, 10, 'fifo',
+                  exc_pattern=r'DiskUsage policy must be one of lru, lfu, ' \
+                  'got \'fifo\'.')
+
+def test_disk_usage_keeps_files_within_max_size():
+    usage = cache.DiskUsage(10)
+    assert_equals(usage.add('/a', 4), [])
+    assert_equals(usage.add('/b', 4), [])
+    assert_equals(usage.size, 8)
+    assert_equals(usage.add('/c', 4), ['/a'])
+    assert_equals(usage.size, 8)
+    assert '/a' not in usage
+    assert_equals(usage.stats(), {'entries': 2, 'size': 8, 'evictions': 1})
+
+def test_disk_usage_lru_evicts_least_recently_used():
+    usage = cache.DiskUsage(10)
+    usage.add('/a', 4)
+    usage.add('/b', 4)
+    usage.touch('/a')
+    assert_equals(usage.add('/c', 4), ['/b'])
+
+def test_disk_usage_lfu_evicts_least_frequently_used():
+    usage = cache.DiskUsage(10, 'lfu')
+    usage.add('/a', 4)
+    usage.touch('/a')
+    usage.touch('/a')
+    usage.add('/b', 4)
+    usage.touch('/b')
+    assert_equals(usage.add('/c', 4), ['/b'])
+
+def test_disk_usage_evicts_down_to_low_water():
+    usage = cache.DiskUsage(100, low_water=0.5)
+    for name in 'abcd':
+        usage.add('/' + name, 25)
+
+    assert_equals(usage.add('/e', 10), ['/a', '/b', '/c'])
+    assert_equals(usage.size, 35)
+
+def test_disk_usage_never_evicts_the_file_being_added():
+    usage = cache.DiskUsage(10)
+    usage.add('/a', 4)
+    assert_equals(usage.add('/big', 20), ['/a'])
+    assert '/big' in usage
+
+def test_disk_usage_replaces_and_discards_files():
+    usage = cache.DiskUsage(10)
+    usage.add('/a', 4)
+    usage.add('/a', 6)
+    assert_equals(usage.size, 6)
+    usage.discard('/a')
+    usage.discard('/unknown')
+    assert_equals(usage.size, 0)
+    assert_equals(len(usage), 0)
+
+def test_single_flight_returns_function_result():
+    flights = cache.SingleFlight()
+    got = flights.do('key', lambda a, b: a + b, 1, b=2)
+    assert_equals(got, 3)
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = cache.SingleFlight()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def render():
+        calls.append(1)
+        release.wait()
+        return 'should-be-rendered-once'
+
+    def request():
+        results.append(flights.do('key', render))
+
+    threads = [threading.Thread(target=request) for i in range(5)]
+    for thread in threads:
+        thread.start()
+
+    while not calls:
+        release.wait(0.01)
+    # give the other threads time to join the flight
+    release.wait(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert_equals(len(calls), 1)
+    assert_equals(results, ['should-be-rendered-once'] * 5)
+
+def test_single_flight_shares_exceptions():
+    flights = cache.SingleFlight()
+    def fail():
+        raise IOError('image not found')
+
+    assert_raises(IOError, flights.do, 'key', fail,
+                  exc_pattern=r'image not found')
+    assert_equals(flights.do('key', lambda: 'next call runs again'),
+                  'next call runs again')
@@ -207,6 +207,26 @@ def test_validate_option_autoreload():
     cp = ConfigValidator(d)
     assert cp.validate_mandatory()
 
+def test_invalid_option_template_autoreload_string():
+    d = FULL_CONFIG_BASE.copy()
+    d['template-autoreload'] = 'should_be_bool'
+    cp = ConfigValidator(d)
+    assert_invalid_option('template-autoreload', 'should_be_bool',
+                          cp.validate_mandatory)
+
+def test_validate_option_template_autoreload():
+    d = FULL_CONFIG_BASE.copy()
+    d['template-autoreload'] = True
+    cp = ConfigValidator(d)
+    assert cp.validate_mandatory()
+
+def test_invalid_option_template_gzip_string():
+    d = FULL_CONFIG_BASE.copy()
+    d['template-gzip'] = 'should_be_bool'
+    cp = ConfigValidator(d)
+    assert_invalid_option('template-gzip', 'should_be_bool',
+                          cp.validate_mandatory)
+
 def test_validate_mandatory_requires_option_application():
     d = FULL_CONFIG_BASE.copy()
     del d['application']
@@ -17,12 +17,15 @@
 # License along with this program; if not, write to the
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
+import time
+import errno
 import cherrypy
 
 from mox import Mox
 from nose.tools import assert_equal
 from utils import assert_raises
 from sponge.contrib import controllers
+from sponge.helpers import image
 
 class TestImageHandler:
     def __init__(self):
@@ -46,7 +49,7 @@ class TestImageHandler:
 
         mox.StubOutWithMock(controllers, 'jpeg')
         ret = 'should_be_a_pil_img'
-        controllers.jpeg(path='arg1/arg2').AndReturn(ret)
+        controllers.jpeg(path='arg1/arg2', profile='original').AndReturn(ret)
 
         mox.ReplayAll()
         got = self.handler('arg1', 'arg2')
@@ -60,7 +63,7 @@ class TestImageHandler:
 
         mox.StubOutWithMock(controllers, 'jpeg')
         ret = 'should_be_a_pil_img'
-        controllers.jpeg(path='arg1/arg2/arg3').AndReturn(ret)
+        controllers.jpeg(path='arg1/arg2/arg3', profile='original').AndReturn(ret)
 
         mox.ReplayAll()
         got = self.handler('arg1', 'arg2', 'arg3')
@@ -74,7 +77,7 @@ class TestImageHandler:
 
         mox.StubOutWithMock(controllers, 'jpeg')
         ret = 'should_be_a_pil_img'
-        controllers.jpeg(path='arg1/arg2/arg3/arg4').AndReturn(ret)
+        controllers.jpeg(path='arg1/arg2/arg3/arg4', profile='original').AndReturn(ret)
 
         mox.ReplayAll()
         got = self.handler('arg1', 'arg2', 'arg3', 'arg4')
@@ -88,7 +91,7 @@ class TestImageHandler:
 
         mox.StubOutWithMock(controllers, 'jpeg')
         ret = 'should_be_a_pil_img'
-        controllers.jpeg(path='crop/arg2/arg3/arg4').AndReturn(ret)
+        controllers.jpeg(path='crop/arg2/arg3/arg4', profile='original').AndReturn(ret)
 
         mox.ReplayAll()
         got = self.handler('crop', 'arg2', 'arg3', 'arg4')
@@ -105,8 +108,8 @@ class TestImageHandler:
 
         ret = 'should_be_a_pil_img'
 
-        controllers.jpeg(path='crop/200x100/image.jpg')
-        controllers.picture(path='image.jpg', width=200, height=100). \
+        controllers.picture(path='image.jpg', width=200, height=100,
+                            profile='original'). \
                                              AndReturn(ret)
 
         mox.ReplayAll()
@@ -143,9 +146,7 @@ class TestImageHandler:
 
         old_jpeg = controllers.jpeg
         old_picture = controllers.picture
-        old_static = controllers.static
-
-        mox.StubOutWithMock(controllers, 'static')
+        mox.StubOutWithMock(controllers, 'send_file')
         controllers.jpeg = mox.CreateMockAnything()
         controllers.picture = mox.CreateMockAnything()
 
@@ -155,13 +156,12 @@ class TestImageHandler:
 
         ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
 
-        controllers.jpeg(path='imgs/image.jpg')
         ImageHandlerStub.fs.join(cache_at, 'imgs/image.jpg'). \
                          AndReturn('/should/be/cache/full/path.jpg')
 
         ImageHandlerStub.fs.exists('/should/be/cache/full/path.jpg'). \
                          AndReturn(True)
-        controllers.static.serve_file('/should/be/cache/full/path.jpg',
+        controllers.send_file('/should/be/cache/full/path.jpg',
                               'image/jpeg'). \
                    AndReturn('should-be-image-data')
 
@@ -192,24 +192,29 @@ class TestImageHandler:
 
         ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
 
-        controllers.jpeg(path='imgs/image.jpg').AndReturn('fake-img')
         ImageHandlerStub.fs.join(cache_at, 'imgs/image.jpg'). \
                          AndReturn('/should/be/cache/full/path.jpg')
 
         ImageHandlerStub.fs.exists('/should/be/cache/full/path.jpg'). \
                          AndReturn(False)
 
+        controllers.jpeg(path='imgs/image.jpg', profile='original').AndReturn('fake-img')
+
         ImageHandlerStub.fs.dirname('/should/be/cache/full/path.jpg'). \
                          AndReturn('dir-name')
 
         ImageHandlerStub.fs.mkdir('dir-name')
 
         file_mock = mox.CreateMockAnything()
-        ImageHandlerStub.fs.open_raw('/should/be/cache/full/path.jpg', 'w'). \
+        temporary_path = controllers.ImageHandler(). \
+                         get_temporary_path('/should/be/cache/full/path.jpg')
+        ImageHandlerStub.fs.open_raw(temporary_path, 'w'). \
                          AndReturn(file_mock)
 
         file_mock.write('fake-img')
         file_mock.close()
+        ImageHandlerStub.fs.rename(temporary_path,
+                                   '/should/be/cache/full/path.jpg')
 
         mox.ReplayAll()
         try:
@@ -223,3 +228,673 @@ class TestImageHandler:
             controllers.jpeg = old_jpeg
             controllers.picture = old_picture
 
+    def test_caching_crop_renders_only_the_requested_variant(self):
+        mox = Mox()
+
+        old_jpeg = controllers.jpeg
+        old_picture = controllers.picture
+        controllers.jpeg = mox.CreateMockAnything()
+        controllers.picture = mox.CreateMockAnything()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.join(cache_at, 'crop/200x100/image.jpg'). \
+                         AndReturn('/cache/crop/200x100/image.jpg')
+        ImageHandlerStub.fs.exists('/cache/crop/200x100/image.jpg'). \
+                         AndReturn(False)
+
+        controllers.picture(path='image.jpg', width=200, height=100,
+                            profile='original'). \
+                            AndReturn('fake-cropped-img')
+
+        ImageHandlerStub.fs.dirname('/cache/crop/200x100/image.jpg'). \
+                         AndReturn('dir-name')
+        ImageHandlerStub.fs.mkdir('dir-name')
+
+        file_mock = mox.CreateMockAnything()
+        temporary_path = controllers.ImageHandler(). \
+                         get_temporary_path('/cache/crop/200x100/image.jpg')
+        ImageHandlerStub.fs.open_raw(temporary_path, 'w'). \
+                         AndReturn(file_mock)
+        file_mock.write('fake-cropped-img')
+        file_mock.close()
+        ImageHandlerStub.fs.rename(temporary_path,
+                                   '/cache/crop/200x100/image.jpg')
+
+        mox.ReplayAll()
+        try:
+            img = ImageHandlerStub(cache_at)
+            got = img('crop', '200x100', 'image.jpg')
+            assert_equal(got, 'fake-cropped-img')
+            mox.VerifyAll()
+        finally:
+            controllers.jpeg = old_jpeg
+            controllers.picture = old_picture
+
+    def test_caching_does_not_cache_not_found_images(self):
+        mox = Mox()
+
+        old_jpeg = controllers.jpeg
+        controllers.jpeg = mox.CreateMockAnything()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.join(cache_at, 'imgs/image.jpg'). \
+                         AndReturn('/should/be/cache/full/path.jpg')
+        ImageHandlerStub.fs.exists('/should/be/cache/full/path.jpg'). \
+                         AndReturn(False)
+        controllers.jpeg(path='imgs/image.jpg', profile='original').AndReturn(u'File not found')
+
+        mox.ReplayAll()
+        try:
+            img = ImageHandlerStub(cache_at)
+            got = img('imgs', 'image.jpg')
+            assert_equal(got, u'File not found')
+            mox.VerifyAll()
+        finally:
+            controllers.jpeg = old_jpeg
+
+    def test_crop_renders_variant_within_single_flight(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler()
+        handler.in_flight = mox.CreateMockAnything()
+        handler.in_flight.do('crop/200x100/image.jpg',
+                             handler.render_variant,
+                             None, 'image.jpg', 200, 100,
+                             profile='original', version=None). \
+                             AndReturn('fake-cropped-img')
+
+        mox.ReplayAll()
+        got = handler('crop', '200x100', 'image.jpg')
+        assert_equal(got, 'fake-cropped-img')
+        assert_equal(cherrypy.response.headers['Content-Type'], 'image/jpeg')
+        mox.VerifyAll()
+
+    def test_memory_cache_is_off_by_default(self):
+        assert self.handler.memory is None
+
+    def test_memory_cache_takes_size_in_bytes(self):
+        handler = controllers.ImageHandler(memory_cache_size=1024)
+        assert_equal(handler.memory.max_size, 1024)
+        assert handler.memory.max_entries is None
+
+    def test_memory_cache_hit_skips_rendering(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler(memory_cache_size=1024)
+        handler.in_flight = mox.CreateMockAnything()
+        handler.in_flight.do('crop/200x100/image.jpg',
+                             handler.render_variant,
+                             None, 'image.jpg', 200, 100,
+                             profile='original', version=None). \
+                             AndReturn('fake-cropped-img')
+
+        mox.ReplayAll()
+        first = handler('crop', '200x100', 'image.jpg')
+        cherrypy.response.headers['Content-Type'] = 'text/html'
+        second = handler('crop', '200x100', 'image.jpg')
+        mox.VerifyAll()
+
+        assert_equal(first, 'fake-cropped-img')
+        assert_equal(second, 'fake-cropped-img')
+        assert_equal(cherrypy.response.headers['Content-Type'], 'image/jpeg')
+        assert_equal(handler.memory.hits, 1)
+        assert_equal(handler.memory.misses, 1)
+
+    def test_memory_cache_is_filled_from_disk_cache(self):
+        mox = Mox()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.join(cache_at, 'imgs/image.jpg'). \
+                         AndReturn('/cache/imgs/image.jpg')
+        ImageHandlerStub.fs.exists('/cache/imgs/image.jpg'). \
+                         AndReturn(True)
+
+        info = mox.CreateMockAnything()
+        info.st_size = 10
+        ImageHandlerStub.fs.stat('/cache/imgs/image.jpg').AndReturn(info)
+
+        file_mock = mox.CreateMockAnything()
+        ImageHandlerStub.fs.open_raw('/cache/imgs/image.jpg', 'rb'). \
+                         AndReturn(file_mock)
+        file_mock.read().AndReturn('cached-img')
+        file_mock.close()
+
+        mox.ReplayAll()
+        img = ImageHandlerStub(cache_at, memory_cache_size=1024)
+        assert_equal(img('imgs', 'image.jpg'), 'cached-img')
+        assert_equal(img('imgs', 'image.jpg'), 'cached-img')
+        mox.VerifyAll()
+
+    def test_memory_cache_does_not_keep_not_found_images(self):
+        mox = Mox()
+
+        old_jpeg = controllers.jpeg
+        controllers.jpeg = mox.CreateMockAnything()
+        controllers.jpeg(path='imgs/image.jpg', profile='original').AndReturn(u'File not found')
+
+        mox.ReplayAll()
+        try:
+            handler = controllers.ImageHandler(memory_cache_size=1024)
+            got = handler('imgs', 'image.jpg')
+            assert_equal(got, u'File not found')
+            assert_equal(len(handler.memory), 0)
+            mox.VerifyAll()
+        finally:
+            controllers.jpeg = old_jpeg
+
+    def test_disk_cache_removes_evicted_files(self):
+        mox = Mox()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        old = mox.CreateMockAnything()
+        old.st_ctime = 1
+        old.st_size = 8
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.locate(cache_at, '*'). \
+                         AndReturn(['/cache/old.jpg', '/cache/new.jpg.1-1.tmp'])
+        ImageHandlerStub.fs.stat('/cache/old.jpg').AndReturn(old)
+        ImageHandlerStub.fs.stat('/cache/new.jpg.1-1.tmp').AndReturn(old)
+        ImageHandlerStub.fs.remove('/cache/new.jpg.1-1.tmp')
+
+        ImageHandlerStub.fs.dirname('/cache/new.jpg').AndReturn('/cache')
+        ImageHandlerStub.fs.mkdir('/cache')
+        temporary_path = controllers.ImageHandler(). \
+                         get_temporary_path('/cache/new.jpg')
+        file_mock = mox.CreateMockAnything()
+        ImageHandlerStub.fs.open_raw(temporary_path, 'w'). \
+                         AndReturn(file_mock)
+        file_mock.write('new-img')
+        file_mock.close()
+        ImageHandlerStub.fs.rename(temporary_path, '/cache/new.jpg')
+        ImageHandlerStub.fs.remove('/cache/old.jpg')
+
+        mox.ReplayAll()
+        img = ImageHandlerStub(cache_at, cache_max_size=10)
+        assert_equal(img.disk.size, 8)
+        img.store('/cache/new.jpg', 'new-img')
+        assert_equal(img.disk.size, 7)
+        assert '/cache/old.jpg' not in img.disk
+        mox.VerifyAll()
+
+    def test_scan_keeps_temporary_files_being_written(self):
+        mox = Mox()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        recent = mox.CreateMockAnything()
+        recent.st_ctime = time.time()
+        recent.st_size = 8
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.locate(cache_at, '*'). \
+                         AndReturn(['/cache/new.jpg.1-1.tmp', '/cache/gone.jpg'])
+        ImageHandlerStub.fs.stat('/cache/new.jpg.1-1.tmp').AndReturn(recent)
+        ImageHandlerStub.fs.stat('/cache/gone.jpg'). \
+                         AndRaise(OSError(errno.ENOENT, 'No such file'))
+
+        mox.ReplayAll()
+        img = ImageHandlerStub(cache_at, cache_max_size=10)
+        assert_equal(len(img.disk), 0)
+        mox.VerifyAll()
+
+    def test_disk_cache_records_hits(self):
+        mox = Mox()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.locate(cache_at, '*').AndReturn([])
+        ImageHandlerStub.fs.join(cache_at, 'imgs/image.jpg'). \
+                         AndReturn('/cache/imgs/image.jpg')
+        ImageHandlerStub.fs.exists('/cache/imgs/image.jpg').AndReturn(True)
+
+        mox.StubOutWithMock(controllers, 'send_file')
+        controllers.send_file('/cache/imgs/image.jpg',
+                              'image/jpeg').AndReturn('cached-img')
+
+        mox.ReplayAll()
+        try:
+            img = ImageHandlerStub(cache_at, cache_max_size=10,
+                                   cache_policy='lfu')
+            img.disk.add('/cache/imgs/image.jpg', 4)
+            img.disk.add('/cache/other.jpg', 4)
+            assert_equal(img('imgs', 'image.jpg'), 'cached-img')
+            assert_equal(img.disk.add('/cache/third.jpg', 4),
+                         ['/cache/other.jpg'])
+            mox.VerifyAll()
+        finally:
+            mox.UnsetStubs()
+
+    def test_refuses_unknown_profiles(self):
+        got = self.handler('imgs', 'image.jpg', profile='huge')
+        assert_equal(cherrypy.response.status, 400)
+        assert_equal(got, u"There is no image profile called 'huge'.")
+
+    def test_refuses_profiles_pil_can_not_write(self):
+        mox = Mox()
+        mox.StubOutWithMock(controllers, 'is_supported')
+        controllers.is_supported('webp').AndReturn(False)
+
+        mox.ReplayAll()
+        try:
+            got = self.handler('crop', '100x50', 'image.jpg', profile='webp')
+            assert_equal(cherrypy.response.status, 400)
+            assert_equal(got, u"The image profile 'webp' needs the WEBP " \
+                         "format, which the installed PIL can not write.")
+            mox.VerifyAll()
+        finally:
+            mox.UnsetStubs()
+
+    def test_profile_given_to_handler_must_exist(self):
+        assert_raises(ValueError, controllers.ImageHandler, profile='huge')
+
+    def test_profile_in_url_is_cached_apart(self):
+        mox = Mox()
+
+        old_picture = controllers.picture
+        controllers.picture = mox.CreateMockAnything()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.join(cache_at, '@png/crop/200x100/image.jpg'). \
+                         AndReturn('/cache/@png/crop/200x100/image.jpg')
+        ImageHandlerStub.fs.exists('/cache/@png/crop/200x100/image.jpg'). \
+                         AndReturn(True)
+
+        mox.StubOutWithMock(controllers, 'send_file')
+        controllers.send_file('/cache/@png/crop/200x100/image.jpg',
+                              'image/png').AndReturn('cached-png')
+
+        mox.ReplayAll()
+        try:
+            img = ImageHandlerStub(cache_at)
+            got = img('crop', '200x100', 'image.jpg', profile='png')
+            assert_equal(got, 'cached-png')
+            mox.VerifyAll()
+        finally:
+            controllers.picture = old_picture
+            mox.UnsetStubs()
+
+    def test_profile_negotiation_varies_on_accept(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler(profile='web')
+        handler.in_flight = mox.CreateMockAnything()
+        handler.in_flight.do('@web/crop/200x100/image.jpg',
+                             handler.render_variant,
+                             None, 'image.jpg', 200, 100,
+                             profile='web', version=None).AndReturn('fake-web-img')
+
+        mox.ReplayAll()
+        cherrypy.request.headers['Accept'] = 'image/png,*/*'
+        try:
+            got = handler('crop', '200x100', 'image.jpg')
+        finally:
+            del cherrypy.request.headers['Accept']
+
+        assert_equal(got, 'fake-web-img')
+        assert_equal(cherrypy.response.headers['Vary'], 'Accept')
+        assert_equal(cherrypy.response.headers['Content-Type'], 'image/jpeg')
+        mox.VerifyAll()
+
+    def test_profile_negotiation_skips_refused_content_types(self):
+        mox = Mox()
+        handler = controllers.ImageHandler(profile='web')
+
+        mox.StubOutWithMock(controllers, 'is_supported')
+        mox.StubOutWithMock(image, 'is_supported')
+        controllers.is_supported('web').AndReturn(True)
+
+        mox.ReplayAll()
+        cherrypy.request.headers['Accept'] = 'image/webp;q=0, */*'
+        try:
+            got = handler.get_profile()
+        finally:
+            del cherrypy.request.headers['Accept']
+            mox.UnsetStubs()
+
+        assert_equal(got, 'web')
+        mox.VerifyAll()
+
+    def test_sizes_must_be_valid(self):
+        assert_raises(TypeError, controllers.ImageHandler, sizes=['big'],
+                      exc_pattern=r'ImageHandler takes sizes like ' \
+                      '"200x100", got \'big\'')
+
+    def test_secret_must_be_string(self):
+        assert_raises(TypeError, controllers.ImageHandler, secret=10,
+                      exc_pattern=r'The secret given to ImageHandler ' \
+                      'must be a string, got 10')
+
+    def test_refuses_sizes_not_allowed_before_rendering(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler(sizes=['200x100', (90, 80)])
+        assert_equal(handler.sizes, set([(200, 100), (90, 80)]))
+        handler.in_flight = mox.CreateMockAnything()
+
+        mox.ReplayAll()
+        got = handler('crop', '201x100', 'image.jpg')
+        assert_equal(got, 'forbidden')
+        assert_equal(cherrypy.response.status, 403)
+        mox.VerifyAll()
+
+    def test_renders_allowed_sizes(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler(sizes=['90x80'])
+        handler.in_flight = mox.CreateMockAnything()
+        handler.in_flight.do('crop/90x80/image.jpg',
+                             handler.render_variant,
+                             None, 'image.jpg', 90, 80,
+                             profile='original', version=None).AndReturn('fake-img')
+
+        mox.ReplayAll()
+        assert_equal(handler('crop', '90x80', 'image.jpg'), 'fake-img')
+        mox.VerifyAll()
+
+    def test_get_variant_takes_sizes_written_exactly(self):
+        handler = controllers.ImageHandler()
+        assert_equal(handler.get_variant(('crop', '200x100', 'a', 'b.jpg')),
+                     ('a/b.jpg', 200, 100))
+        for size in ('200x100a', '200x100b', '0200x100', '200x0100', 'x100'):
+            got = handler.get_variant(('crop', size, 'a.jpg'))
+            assert got is None, 'Expected %r not to be a variant, ' \
+                   'got %r' % (size, got)
+
+    def test_sizes_written_otherwise_are_not_rendered(self):
+        mox = Mox()
+
+        mox.StubOutWithMock(controllers, 'jpeg')
+        handler = controllers.ImageHandler(sizes=['200x100'])
+        handler.in_flight = mox.CreateMockAnything()
+
+        def not_found(path, profile):
+            cherrypy.response.status = 404
+            return u'File not found'
+
+        controllers.jpeg(path='crop/200x100a/a.jpg', profile='original'). \
+                        WithSideEffects(not_found).AndReturn(u'File not found')
+        controllers.jpeg(path='crop/0200x100/a.jpg', profile='original'). \
+                        WithSideEffects(not_found).AndReturn(u'File not found')
+
+        mox.ReplayAll()
+        try:
+            for size in ('200x100a', '0200x100'):
+                cherrypy.response.status = 200
+                assert_equal(handler('crop', size, 'a.jpg'),
+                             u'File not found')
+                assert_equal(cherrypy.response.status, 404)
+            mox.VerifyAll()
+        finally:
+            mox.UnsetStubs()
+
+    def test_get_url_signs_variants(self):
+        handler = controllers.ImageHandler(secret='s3cr3t')
+        url = handler.get_url('/dog.jpg', 200, 100)
+        path, query = url.split('?')
+        assert_equal(path, 'crop/200x100/dog.jpg')
+        assert_equal(query, 'sign=%s' % handler.sign('crop/200x100/dog.jpg'))
+
+        url = handler.get_url('dog.jpg', 200, 100, profile='web')
+        assert url.startswith('crop/200x100/dog.jpg?profile=web&sign='), url
+
+        assert_equal(controllers.ImageHandler().get_url('dog.jpg', 20, 10),
+                     'crop/20x10/dog.jpg')
+
+    def test_get_url_quotes_path_but_signs_it_unquoted(self):
+        handler = controllers.ImageHandler(secret='s3cr3t')
+        url = handler.get_url(u'my dog,1.jpg', 200, 100)
+        path, query = url.split('?')
+        assert_equal(path, 'crop/200x100/my%20dog%2C1.jpg')
+
+        signature = query.split('=')[1]
+        variant = handler.get_variant(('crop', '200x100', 'my dog,1.jpg'))
+        assert handler.is_allowed('crop/200x100/my dog,1.jpg', variant,
+                                  {'sign': signature}), \
+               'The signature should match the path CherryPy gives back'
+
+    def test_refuses_unsigned_variants_before_rendering(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler(secret='s3cr3t')
+        handler.in_flight = mox.CreateMockAnything()
+
+        mox.ReplayAll()
+        signature = handler.sign('crop/200x100/image.jpg')
+        for kw in ({}, {'sign': 'wrong'}, {'sign': signature[:-1] + 'x'},
+                   {'sign': signature, 'profile': 'png'}):
+            got = handler('crop', '200x100', 'image.jpg', **kw)
+            assert_equal(got, 'forbidden')
+            assert_equal(cherrypy.response.status, 403)
+        mox.VerifyAll()
+
+    def test_renders_signed_variants(self):
+        mox = Mox()
+
+        handler = controllers.ImageHandler(secret='s3cr3t')
+        handler.in_flight = mox.CreateMockAnything()
+        handler.in_flight.do('@png/crop/200x100/image.jpg',
+                             handler.render_variant,
+                             None, 'image.jpg', 200, 100,
+                             profile='png', version=None).AndReturn('fake-img')
+
+        mox.ReplayAll()
+        signature = handler.sign('crop/200x100/image.jpg', 'png')
+        got = handler('crop', '200x100', 'image.jpg', profile='png',
+                      sign=signature)
+        assert_equal(got, 'fake-img')
+        mox.VerifyAll()
+
+    def test_originals_need_no_signature(self):
+        mox = Mox()
+
+        old_jpeg = controllers.jpeg
+        controllers.jpeg = mox.CreateMockAnything()
+        controllers.jpeg(path='imgs/image.jpg', profile='original'). \
+                         AndReturn('fake-img')
+
+        mox.ReplayAll()
+        try:
+            handler = controllers.ImageHandler(sizes=['90x80'],
+                                               secret='s3cr3t')
+            assert_equal(handler('imgs', 'image.jpg'), 'fake-img')
+            mox.VerifyAll()
+        finally:
+            controllers.jpeg = old_jpeg
+
+    def test_memory_cache_leaves_large_images_on_disk(self):
+        mox = Mox()
+
+        cache_at = '/full/path/to/cache'
+        class ImageHandlerStub(controllers.ImageHandler):
+            fs = mox.CreateMockAnything()
+
+        ImageHandlerStub.fs.exists(cache_at).AndReturn(True)
+        ImageHandlerStub.fs.join(cache_at, 'imgs/image.jpg'). \
+                         AndReturn('/cache/imgs/image.jpg')
+        ImageHandlerStub.fs.exists('/cache/imgs/image.jpg'). \
+                         AndReturn(True)
+
+        info = mox.CreateMockAnything()
+        info.st_size = 129
+        ImageHandlerStub.fs.stat('/cache/imgs/image.jpg').AndReturn(info)
+
+        mox.StubOutWithMock(controllers, 'send_file')
+        controllers.send_file('/cache/imgs/image.jpg',
+                              'image/jpeg').AndReturn('streamed-img')
+
+        mox.ReplayAll()
+        try:
+            img = ImageHandlerStub(cache_at, memory_cache_size=1024)
+            assert_equal(img('imgs', 'image.jpg'), 'streamed-img')
+            assert_equal(len(img.memory), 0)
+            mox.VerifyAll()
+        finally:
+            mox.UnsetStubs()
+
+def test_parse_size():
+    assert_equal(controllers.parse_size('200x100'), (200, 100))
+    assert_equal(controllers.parse_size((20, 10)), (20, 10))
+    assert_equal(controllers.parse_size('200x'), None)
+    assert_equal(controllers.parse_size(200), None)
+
+def test_same_signature():
+    assert controllers.same_signature('abc', 'abc')
+    assert not controllers.same_signature('abd', 'abc')
+    assert not controllers.same_signature('ab', 'abc')
+
+class TestSrcset:
+    def setup(self):
+        self.mox = Mox()
+        self.mox.StubOutWithMock(controllers, 'image_info')
+        self.mox.StubOutWithMock(controllers, 'get_renderer')
+        self.renderer = self.mox.CreateMockAnything()
+        cherrypy.request.base = 'http://localhost'
+
+    def teardown(self):
+        self.mox.UnsetStubs()
+
+    def test_needs_base_url(self):
+        handler = controllers.ImageHandler()
+        assert_raises(ValueError, handler.srcset, 'dog.jpg', [100],
+                      exc_pattern=r'ImageHandler needs to know its ' \
+                      'base_url to build srcset urls.')
+
+    def test_missing_images_have_no_srcset(self):
+        controllers.image_info('dog.jpg').AndReturn(None)
+
+        self.mox.ReplayAll()
+        handler = controllers.ImageHandler(base_url='/images/')
+        assert_equal(handler.srcset('/dog.jpg', [100]), '')
+        self.mox.VerifyAll()
+
+    def test_keeps_proportions_and_skips_bigger_widths(self):
+        controllers.image_info('dog.jpg').AndReturn({'width': 800,
+                                                     'height': 600,
+                                                     'mtime': 10.0,
+                                                     'size': 1000})
+
+        self.mox.ReplayAll()
+        handler = controllers.ImageHandler(base_url='/images/')
+        got = handler.srcset('dog.jpg', [1600, 400, 200, 400])
+        assert_equal(got, 'http://localhost/images/crop/200x150/dog.jpg ' \
+                     '200w, http://localhost/images/crop/400x300/dog.jpg 400w')
+        self.mox.VerifyAll()
+
+    def test_uses_image_width_when_all_widths_are_bigger(self):
+        controllers.image_info('dog.jpg').AndReturn({'width': 80,
+                                                     'height': 60,
+                                                     'mtime': 10.0,
+                                                     'size': 1000})
+
+        self.mox.ReplayAll()
+        handler = controllers.ImageHandler(base_url='/images')
+        assert_equal(handler.srcset('dog.jpg', [100, 200]),
+                     'http://localhost/images/crop/80x60/dog.jpg 80w')
+        self.mox.VerifyAll()
+
+    def test_skips_sizes_not_allowed(self):
+        controllers.image_info('dog.jpg').AndReturn({'width': 800,
+                                                     'height': 600,
+                                                     'mtime': 10.0,
+                                                     'size': 1000})
+
+        self.mox.ReplayAll()
+        handler = controllers.ImageHandler(base_url='/images',
+                                           sizes=['400x300'])
+        assert_equal(handler.srcset('dog.jpg', [200, 400]),
+                     'http://localhost/images/crop/400x300/dog.jpg 400w')
+        self.mox.VerifyAll()
+
+    def test_quotes_paths(self):
+        controllers.image_info('my dog.jpg').AndReturn({'width': 800,
+                                                        'height': 600,
+                                                        'mtime': 10.0,
+                                                        'size': 1000})
+
+        self.mox.ReplayAll()
+        handler = controllers.ImageHandler(base_url='/images')
+        assert_equal(handler.srcset('my dog.jpg', [400]),
+                     'http://localhost/images/crop/400x300/my%20dog.jpg 400w')
+        self.mox.VerifyAll()
+
+    def test_schedules_variants_not_cached(self):
+        controllers.image_info('dog.jpg').AndReturn({'width': 800,
+                                                     'height': 600,
+                                                     'mtime': 10.0,
+                                                     'size': 1000})
+
+        handler = controllers.ImageHandler(base_url='/images',
+                                           memory_cache_size=1024,
+                                           profile='png')
+        memory_key = handler.get_memory_key('@png/crop/200x150/dog.jpg',
+                                            (10.0, 1000))
+        handler.memory.set(memory_key, 'cached-img')
+
+        controllers.get_renderer().AndReturn(self.renderer)
+        self.renderer.schedule(handler, 'dog.jpg', 400, 300, 'png')
+
+        self.mox.ReplayAll()
+        handler.srcset('dog.jpg', [200, 400])
+        self.mox.VerifyAll()
+
+    def test_prerender_skips_cached_variants(self):
+        handler = controllers.ImageHandler(memory_cache_size=1024)
+        handler.memory.set('crop/200x150/dog.jpg', 'cached-img')
+        handler.in_flight = self.mox.CreateMockAnything()
+        handler.in_flight.do('crop/400x300/dog.jpg',
+                             handler.render_variant,
+                             None, 'dog.jpg', 400, 300,
+                             profile='original', version=None).AndReturn('rendered-img')
+
+        self.mox.ReplayAll()
+        handler.prerender('dog.jpg', 200, 150)
+        handler.prerender('dog.jpg', 400, 300)
+        assert_equal(handler.memory.get('crop/400x300/dog.jpg'),
+                     'rendered-img')
+        self.mox.VerifyAll()
+
+def test_background_renderer_runs_each_job_once():
+    class HandlerStub(object):
+        rendered = []
+        def prerender(self, *args):
+            self.rendered.append(args)
+
+    handler = HandlerStub()
+    renderer = controllers.BackgroundRenderer(workers=0, queue_size=1)
+    assert renderer.schedule(handler, 'dog.jpg', 200, 150, 'original')
+    assert not renderer.schedule(handler, 'dog.jpg', 200, 150, 'original')
+    assert not renderer.schedule(handler, 'cat.jpg', 200, 150, 'original')
+
+    worker = controllers.threading.Thread(target=renderer.work)
+    worker.setDaemon(True)
+    worker.start()
+    renderer.join()
+
+    assert_equal(handler.rendered, [('dog.jpg', 200, 150, 'original')])
+    assert_equal(renderer.pending, set())
+
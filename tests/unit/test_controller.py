@@ -62,3 +62,17 @@ def test_controller_with_route_without_name():
             'method': 'some_method'
         }),
     ])
+
+def test_register_route_splits_route_in_parts():
+    controller.register_route('edit_photo', '/photo/:id/edit/{size}/*rest')
+    try:
+        assert_equal(controller.routes_index['edit_photo'], [
+            (False, ''),
+            (False, 'photo'),
+            (True, 'id'),
+            (False, 'edit'),
+            (True, 'size'),
+            (True, 'rest'),
+        ])
+    finally:
+        del controller.routes_index['edit_photo']
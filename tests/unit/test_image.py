@@ -22,6 +22,7 @@ import Image
 import cherrypy
 
 from mox import Mox
+from nose.tools import assert_equals
 from utils import assert_raises
 from os.path import join
 
@@ -49,6 +50,9 @@ def test_jpeg_success():
     return_mock = mox.CreateMockAnything()
     img_mock = mox.CreateMockAnything()
 
+    img_mock.format = 'PNG'
+    img_mock.mode = 'RGB'
+
     stringio_mock.getvalue().AndReturn(return_mock)
 
     image.StringIO.StringIO().AndReturn(stringio_mock)
@@ -69,6 +73,27 @@ def test_jpeg_success():
 
     del cherrypy.config['image.dir']
 
+def test_jpeg_serves_jpeg_files_without_encoding():
+    mox = Mox()
+
+    mox.StubOutWithMock(image, 'Image')
+    mox.StubOutWithMock(image, 'static')
+
+    img_mock = mox.CreateMockAnything()
+    img_mock.format = 'JPEG'
+
+    image.Image.open('/path/to/images/img.jpg').AndReturn(img_mock)
+    image.static.serve_file('/path/to/images/img.jpg', 'image/jpeg'). \
+                 AndReturn('should-be-the-file-body')
+
+    mox.ReplayAll()
+    try:
+        got = image.jpeg('img.jpg', base_path='/path/to/images')
+        assert got == 'should-be-the-file-body', 'Expected the file body, got %r' % got
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
 def test_jpeg_return_string_when_file_not_found():
     filename = 'foo-file.jpg'
     path = join('bazbar', filename)
@@ -96,6 +121,29 @@ def test_crop_to_fit_lower():
     ret = image.crop_to_fit(img, (320, 240))
     assert ret.size == (320, 240), 'Got expected size 320x240, got %rx%r.' % ret.size
 
+def test_crop_to_fit_reduces_before_resampling():
+    mox = Mox()
+
+    img = Image.new('RGB', (1000, 1000))
+    cropped_mock = mox.CreateMockAnything()
+
+    mox.StubOutWithMock(img, 'crop')
+    img.crop((0, 0, 999, 999)).AndReturn(cropped_mock)
+    even_mock = mox.CreateMockAnything()
+    halved_mock = mox.CreateMockAnything()
+    cropped_mock.crop((0, 0, 998, 998)).AndReturn(even_mock)
+    even_mock.resize((499, 499), Image.BILINEAR).AndReturn(halved_mock)
+    halved_mock.resize((100, 100), Image.ANTIALIAS).AndReturn('thumbnail')
+
+    mox.ReplayAll()
+    assert_equals(image.crop_to_fit(img, (100, 100)), 'thumbnail')
+    mox.VerifyAll()
+
+def test_crop_to_fit_resamples_small_crops_once():
+    img = Image.new('RGB', (250, 250))
+    ret = image.crop_to_fit(img, (100, 100))
+    assert_equals(ret.size, (100, 100))
+
 def test_picture_takes_3_parameters():
     assert_raises(TypeError, image.picture, exc_pattern=r'picture.. takes at least 3 arguments .0 given.')
 
@@ -120,6 +168,7 @@ def test_picture_with_crop_true_will_crop_to_fit():
 
     img_mock = mox.CreateMockAnything()
     img_mock.size = 300, 300
+    img_mock.mode = 'RGB'
 
     stringio_mock = mox.CreateMockAnything()
     return_mock = mox.CreateMockAnything()
@@ -163,9 +212,12 @@ def test_picture_with_center_true_will_create_new_image_and_paste():
     cherrypy.config['image.dir'] = base_path
 
     new_img_mock = mox.CreateMockAnything()
+    new_img_mock.mode = 'RGBA'
+    rgb_img_mock = mox.CreateMockAnything()
 
     new_img_mock.paste(img_mock, (-100, -100))
-    new_img_mock.save(stringio_mock, 'JPEG', quality=100)
+    new_img_mock.convert('RGB').AndReturn(rgb_img_mock)
+    rgb_img_mock.save(stringio_mock, 'JPEG', quality=100)
 
     image.Image.open(join(base_path, path)).AndReturn(img_mock)
     image.Image.new('RGBA', (100, 100), 0xffffff).AndReturn(new_img_mock)
@@ -177,3 +229,230 @@ def test_picture_with_center_true_will_create_new_image_and_paste():
     mox.VerifyAll()
 
     del cherrypy.config['image.dir']
+
+def test_image_pool_takes_positive_workers():
+    assert_raises(TypeError, image.ImagePool, 0, 10,
+                  exc_pattern=r'ImagePool takes a positive integer as ' \
+                  'workers parameter, got 0.')
+
+def test_image_pool_takes_positive_queue_size():
+    assert_raises(TypeError, image.ImagePool, 2, None,
+                  exc_pattern=r'ImagePool takes a positive integer as ' \
+                  'queue_size parameter, got None.')
+
+def test_image_pool_runs_function_within_workers():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'multiprocessing')
+
+    pool_mock = mox.CreateMockAnything()
+    result_mock = mox.CreateMockAnything()
+
+    image.multiprocessing.Pool(2).AndReturn(pool_mock)
+    pool_mock.apply_async(image.render_picture, ('/full/path.jpg', 10, 10)). \
+                          AndReturn(result_mock)
+    result_mock.get(30).AndReturn('should-be-image-data')
+
+    mox.ReplayAll()
+    try:
+        pool = image.ImagePool(2, 1)
+        got = pool.run(image.render_picture, '/full/path.jpg', 10, 10)
+        assert got == 'should-be-image-data', 'Expected image data, got %r' % got
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_image_pool_refuses_work_when_queue_is_full():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'multiprocessing')
+    image.multiprocessing.Pool(2).AndReturn(mox.CreateMockAnything())
+
+    mox.ReplayAll()
+    try:
+        pool = image.ImagePool(2, 1)
+        pool.slots.acquire()
+        try:
+            pool.run(image.render_picture, '/full/path.jpg', 10, 10)
+            assert False, 'ImagePool.run should raise HTTPError'
+        except cherrypy.HTTPError, e:
+            assert e.status == 503, 'Expected status 503, got %r' % e.status
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_image_pool_answers_503_on_timeout_and_keeps_the_slot():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'multiprocessing')
+
+    pool_mock = mox.CreateMockAnything()
+    result_mock = mox.CreateMockAnything()
+
+    image.multiprocessing.Pool(2).AndReturn(pool_mock)
+    pool_mock.apply_async(image.render_picture, ('/full/path.jpg', 10, 10)). \
+                          AndReturn(result_mock)
+    result_mock.get(5).AndRaise(image.TimeoutError())
+
+    mox.ReplayAll()
+    try:
+        pool = image.ImagePool(2, 1, timeout=5)
+        pool.release_when_done = lambda result: None
+        try:
+            pool.run(image.render_picture, '/full/path.jpg', 10, 10)
+            assert False, 'ImagePool.run should raise HTTPError'
+        except cherrypy.HTTPError, e:
+            assert e.status == 503, 'Expected status 503, got %r' % e.status
+
+        assert not pool.slots.acquire(False), \
+               'The slot should be kept while the worker is busy'
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_image_pool_releases_slot_when_done():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'multiprocessing')
+    image.multiprocessing.Pool(2).AndReturn(mox.CreateMockAnything())
+
+    result_mock = mox.CreateMockAnything()
+    result_mock.wait()
+
+    mox.ReplayAll()
+    try:
+        pool = image.ImagePool(2, 1)
+        pool.slots.acquire()
+        pool.release_when_done(result_mock)
+        assert pool.slots.acquire(False), 'The slot should be released'
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_start_pool_creates_pool_when_configured():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'ImagePool')
+    image.ImagePool(2, 8, 30).AndReturn('should-be-a-pool')
+
+    cherrypy.config['image.workers'] = 2
+    mox.ReplayAll()
+    try:
+        image.start_pool()
+        assert image.get_pool() == 'should-be-a-pool', 'Expected the pool, got %r' % image.get_pool()
+        mox.VerifyAll()
+    finally:
+        image._pool = None
+        del cherrypy.config['image.workers']
+        mox.UnsetStubs()
+
+def test_start_pool_does_nothing_when_not_configured():
+    image.start_pool()
+    assert image.get_pool() is None, 'Expected no pool'
+
+def test_get_pool_returns_none_when_not_configured():
+    assert image.get_pool() is None, 'Expected no pool'
+
+def test_picture_runs_within_pool_when_configured():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'get_pool')
+
+    pool_mock = mox.CreateMockAnything()
+    image.get_pool().AndReturn(pool_mock)
+    pool_mock.run(image.render_picture, join('/base/path', 'image.jpg'),
+                  100, 50, True, True, 0xffffff). \
+                  AndReturn('should-be-image-data')
+
+    mox.ReplayAll()
+    try:
+        got = image.picture('image.jpg', 100, 50, base_path='/base/path')
+        assert got == 'should-be-image-data', 'Expected image data, got %r' % got
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_get_profile_name_defaults_to_original():
+    assert_equals(image.get_profile_name(), 'original')
+
+def test_get_profile_name_uses_configured_profile():
+    cherrypy.config['image.profile'] = 'web'
+    try:
+        assert_equals(image.get_profile_name(), 'web')
+        assert_equals(image.get_profile_name('png'), 'png')
+    finally:
+        del cherrypy.config['image.profile']
+
+def test_get_profile_name_refuses_unknown_profiles():
+    assert_raises(ValueError, image.get_profile_name, 'huge',
+                  exc_pattern=r"There is no image profile called 'huge'.")
+
+def test_register_profile():
+    image.register_profile('thumbnail', 'PNG', optimize=True)
+    try:
+        assert_equals(image.profiles['thumbnail'],
+                      {'format': 'PNG', 'optimize': True})
+        assert_equals(image.get_content_type('thumbnail'), 'image/png')
+    finally:
+        del image.profiles['thumbnail']
+
+def test_register_profile_refuses_unknown_formats():
+    assert_raises(ValueError, image.register_profile, 'bmp', 'BMP',
+                  exc_pattern=r"Image profiles must have one of the " \
+                  "formats JPEG, PNG, WEBP, got 'BMP'.")
+
+def test_negotiate_uses_preferred_profile_when_accepted():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'is_supported')
+    image.is_supported('webp').AndReturn(True)
+    image.is_supported('webp').AndReturn(False)
+
+    mox.ReplayAll()
+    try:
+        assert_equals(image.negotiate('web', ['image/webp', '*/*']), 'webp')
+        assert_equals(image.negotiate('web', ['image/webp', '*/*']), 'web')
+        assert_equals(image.negotiate('web', ['*/*']), 'web')
+        assert_equals(image.negotiate('web', []), 'web')
+        assert_equals(image.negotiate('original', ['image/webp']),
+                      'original')
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_encode_leaves_out_disabled_flags():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'StringIO')
+
+    img_mock = mox.CreateMockAnything()
+    img_mock.mode = 'RGB'
+    img_mock.size = 10, 10
+    stringio_mock = mox.CreateMockAnything()
+
+    image.StringIO.StringIO().AndReturn(stringio_mock)
+    img_mock.save(stringio_mock, 'JPEG', quality=75, progressive=True)
+    stringio_mock.getvalue().AndReturn('image-data')
+
+    mox.ReplayAll()
+    try:
+        got = image.encode(img_mock, {'format': 'JPEG', 'quality': 75,
+                                      'optimize': False,
+                                      'progressive': True,
+                                      'prefer': ['webp']})
+        assert_equals(got, 'image-data')
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_picture_sends_profile_to_pool():
+    mox = Mox()
+    mox.StubOutWithMock(image, 'get_pool')
+
+    pool_mock = mox.CreateMockAnything()
+    image.get_pool().AndReturn(pool_mock)
+    pool_mock.run(image.render_picture, join('/base/path', 'image.jpg'),
+                  100, 50, True, True, 0xffffff, image.profiles['png']). \
+                  AndReturn('should-be-image-data')
+
+    mox.ReplayAll()
+    try:
+        got = image.picture('image.jpg', 100, 50, base_path='/base/path',
+                            profile='png')
+        assert_equals(got, 'should-be-image-data')
+        assert_equals(cherrypy.response.headers['Content-type'], 'image/png')
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
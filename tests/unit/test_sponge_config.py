@@ -5,6 +5,7 @@ from mox import Mox
 from nose.tools import assert_equals
 from utils import assert_raises
 from sponge import core
+from sponge.controller import routes_index
 
 config_dict = {
     'run-as': 'wsgi',
@@ -110,6 +111,7 @@ def test_can_setup_all_without_routes_attr():
     sp.set_setting('sponge', config_dict)
     sp.set_setting('sponge.root', '/absolute/path')
     sp.set_setting('engine.autoreload_on', False)
+    sp.set_setting('template.auto_reload', False)
     sp.set_setting('sponge.extra', config_dict['extra'])
     sp.set_setting('template.dir', '/path/to/project/templates')
     sp.set_setting('image.dir', '/path/to/project/images')
@@ -172,6 +174,7 @@ def test_can_setup_all_without_routes_dict():
     sp.set_setting('sponge', config_dict)
     sp.set_setting('sponge.root', '/absolute/path')
     sp.set_setting('engine.autoreload_on', False)
+    sp.set_setting('template.auto_reload', False)
     sp.set_setting('sponge.extra', config_dict['extra'])
     sp.set_setting('template.dir', '/path/to/project/templates')
     sp.set_setting('image.dir', '/path/to/project/images')
@@ -294,9 +297,226 @@ def test_can_setup_all_with_routes():
     try:
         sp.setup_all('/absolute/path/')
         mox.VerifyAll()
+        assert_equals(routes_index['show_photos'], [(False, ''),
+                                                    (False, 'photos')])
+        assert_equals(routes_index['MyPhotoController.edit'], [(False, ''),
+                                                               (False, 'photo'),
+                                                               (True, 'id'),
+                                                               (False, 'edit')])
     finally:
         core.ClassLoader = class_loader
         core.cherrypy = cherrypy
+        routes_index.clear()
+        mox.UnsetStubs()
+
+def test_setup_all_optional_settings():
+    mox = Mox()
+    d = {}
+    mox.StubOutWithMock(core, 'os')
+    mox.StubOutWithMock(core.sys, 'path')
+
+    core.os.getcwd().AndReturn('should be current working dir')
+    core.sys.path.append('should be current working dir')
+
+    class_loader = core.ClassLoader
+    cherrypy = core.cherrypy
+    core.ClassLoader = mox.CreateMockAnything()
+    core.cherrypy = mox.CreateMockAnything()
+    core.cherrypy.tree = mox.CreateMockAnything()
+
+    cloader_mock = mox.CreateMockAnything()
+    core.ClassLoader('/absolute/path/path/to/project').AndReturn(cloader_mock)
+
+    class_mock = mox.CreateMockAnything()
+    class_mock.__routes__ = 'blabla'
+
+    cloader_mock.load('SomeController').AndReturn(class_mock)
+    class_mock().AndReturn('should_be_some_controller_instance')
+
+    core.cherrypy.tree.mount(root='should_be_some_controller_instance',
+                             script_name='/', config={
+                                 '/media': {
+                                     'tools.staticdir.dir': '/absolute/path/my/media',
+                                     'tools.staticdir.on': True
+                                 }
+                             })
+
+    my_config = config_dict.copy()
+    my_config['template-autoreload'] = True
+    my_config['template-gzip'] = True
+    my_config['template-cache-size'] = 500
+    my_config['image-workers'] = 4
+    my_config['image-queue'] = 16
+    my_config['image-profile'] = 'web'
+    my_config['image-sizes'] = ['200x100', '90x80']
+    my_config['image-index'] = '/path/to/project/images.index'
+    my_config['image-sendfile'] = 'X-Accel-Redirect'
+    my_config['image-sendfile-prefix'] = '/internal'
+    cf = core.ConfigValidator(my_config)
+    sp = core.SpongeConfig(d, cf)
+    sp.set_setting = mox.CreateMockAnything()
+
+    sp.set_setting('server.socket_port', 80)
+    sp.set_setting('server.socket_host', '0.0.0.0')
+    sp.set_setting('tools.sessions.on', True)
+    sp.set_setting('tools.sessions.timeout', 60)
+    sp.set_setting('tools.encode.on', True)
+    sp.set_setting('tools.encode.encoding', 'utf-8')
+    sp.set_setting('tools.trailing_slash.on', True)
+    sp.set_setting('sponge', my_config)
+    sp.set_setting('sponge.root', '/absolute/path')
+    sp.set_setting('engine.autoreload_on', False)
+    sp.set_setting('template.auto_reload', True)
+    sp.set_setting('template.gzip', True)
+    sp.set_setting('template.cache_size', 500)
+    sp.set_setting('sponge.extra', config_dict['extra'])
+    sp.set_setting('template.dir', '/path/to/project/templates')
+    sp.set_setting('image.dir', '/path/to/project/images')
+    sp.set_setting('image.workers', 4)
+    sp.set_setting('image.queue_size', 16)
+    sp.set_setting('image.profile', 'web')
+    sp.set_setting('image.sizes', ['200x100', '90x80'])
+    sp.set_setting('image.index', '/path/to/project/images.index')
+    sp.set_setting('image.sendfile', 'X-Accel-Redirect')
+    sp.set_setting('image.sendfile_prefix', '/internal')
+
+    mox.ReplayAll()
+    try:
+        sp.setup_all('/absolute/path/')
+        mox.VerifyAll()
+    finally:
+        core.ClassLoader = class_loader
+        core.cherrypy = cherrypy
+        mox.UnsetStubs()
+
+def test_precompile_templates_loads_all_html_files():
+    mox = Mox()
+    mox.StubOutWithMock(core, 'get_loader')
+
+    loader_mock = mox.CreateMockAnything()
+    core.get_loader('/path/to/templates', False).AndReturn(loader_mock)
+
+    class SpongeConfigStub(core.SpongeConfig):
+        fs = mox.CreateMockAnything()
+
+    SpongeConfigStub.fs.locate('/path/to/templates', '*.html'). \
+                        AndReturn(['/path/to/templates/index.html',
+                                   '/path/to/templates/sub/list.html'])
+    loader_mock.load('index.html')
+    loader_mock.load('sub/list.html')
+
+    sp = SpongeConfigStub({}, core.ConfigValidator({}))
+    mox.ReplayAll()
+    try:
+        count, seconds = sp.precompile_templates('/path/to/templates', False)
+        assert_equals(count, 2)
+        assert isinstance(seconds, float), 'Expected a float, got %r' % seconds
+        mox.VerifyAll()
+    finally:
+        mox.UnsetStubs()
+
+def test_precompile_templates_warns_when_cache_is_too_small():
+    mox = Mox()
+    mox.StubOutWithMock(core, 'get_loader')
+
+    loader_mock = mox.CreateMockAnything()
+    core.get_loader('/path/to/templates', False).AndReturn(loader_mock)
+
+    class SpongeConfigStub(core.SpongeConfig):
+        fs = mox.CreateMockAnything()
+
+    SpongeConfigStub.fs.locate('/path/to/templates', '*.html'). \
+                        AndReturn(['/path/to/templates/a.html',
+                                   '/path/to/templates/b.html',
+                                   '/path/to/templates/c.html'])
+    loader_mock.load('a.html')
+    loader_mock.load('b.html')
+    loader_mock.load('c.html')
+
+    sp = SpongeConfigStub({}, core.ConfigValidator({}))
+    core.cherrypy.config['template.cache_size'] = 2
+    mox.ReplayAll()
+    sys.stderr = StringIO()
+    try:
+        count, seconds = sp.precompile_templates('/path/to/templates', False)
+        assert_equals(count, 3)
+        assert_equals(sys.stderr.getvalue(),
+                      '\nWARNING: found 3 templates, but only 2 are kept ' \
+                      'compiled, set template-cache-size in settings.yml ' \
+                      'to keep all of them\n')
+        mox.VerifyAll()
+    finally:
+        del core.cherrypy.config['template.cache_size']
+        sys.stderr = sys.__stderr__
+        mox.UnsetStubs()
+
+def test_setup_all_precompiles_templates_when_configured():
+    mox = Mox()
+    d = {}
+    mox.StubOutWithMock(core, 'os')
+    mox.StubOutWithMock(core.sys, 'path')
+
+    core.os.getcwd().AndReturn('should be current working dir')
+    core.sys.path.append('should be current working dir')
+
+    class_loader = core.ClassLoader
+    cherrypy = core.cherrypy
+    core.ClassLoader = mox.CreateMockAnything()
+    core.cherrypy = mox.CreateMockAnything()
+    core.cherrypy.tree = mox.CreateMockAnything()
+
+    cloader_mock = mox.CreateMockAnything()
+    core.ClassLoader('/absolute/path/path/to/project').AndReturn(cloader_mock)
+
+    class_mock = mox.CreateMockAnything()
+    class_mock.__routes__ = 'blabla'
+
+    cloader_mock.load('SomeController').AndReturn(class_mock)
+    class_mock().AndReturn('should_be_some_controller_instance')
+
+    core.cherrypy.tree.mount(root='should_be_some_controller_instance',
+                             script_name='/', config={
+                                 '/media': {
+                                     'tools.staticdir.dir': '/absolute/path/my/media',
+                                     'tools.staticdir.on': True
+                                 }
+                             })
+
+    my_config = config_dict.copy()
+    my_config['template-precompile'] = True
+    cf = core.ConfigValidator(my_config)
+    sp = core.SpongeConfig(d, cf)
+    sp.set_setting = mox.CreateMockAnything()
+    sp.precompile_templates = mox.CreateMockAnything()
+
+    sp.set_setting('server.socket_port', 80)
+    sp.set_setting('server.socket_host', '0.0.0.0')
+    sp.set_setting('tools.sessions.on', True)
+    sp.set_setting('tools.sessions.timeout', 60)
+    sp.set_setting('tools.encode.on', True)
+    sp.set_setting('tools.encode.encoding', 'utf-8')
+    sp.set_setting('tools.trailing_slash.on', True)
+    sp.set_setting('sponge', my_config)
+    sp.set_setting('sponge.root', '/absolute/path')
+    sp.set_setting('engine.autoreload_on', False)
+    sp.set_setting('template.auto_reload', False)
+    sp.set_setting('sponge.extra', config_dict['extra'])
+    sp.set_setting('template.dir', '/path/to/project/templates')
+    sp.precompile_templates('/path/to/project/templates', False). \
+                            AndReturn((3, 0.25))
+    sp.set_setting('image.dir', '/path/to/project/images')
+
+    mox.ReplayAll()
+    sys.stdout = StringIO()
+    try:
+        sp.setup_all('/absolute/path/')
+        assert_equals(sys.stdout.getvalue(),
+                      'Sponge compiled 3 templates in 0.250 seconds\n')
+        mox.VerifyAll()
+    finally:
+        core.ClassLoader = class_loader
+        core.cherrypy = cherrypy
+        sys.stdout = sys.__stdout__
         mox.UnsetStubs()
 
 def test_boot():
@@ -360,6 +580,7 @@ def test_boot():
     sp.set_setting('sponge', config_dict)
     sp.set_setting('sponge.root', '/absolute/path')
     sp.set_setting('engine.autoreload_on', False)
+    sp.set_setting('template.auto_reload', False)
     sp.set_setting('sponge.extra', config_dict['extra'])
     sp.set_setting('template.dir', '/path/to/project/templates')
     sp.set_setting('image.dir', '/path/to/project/images')
@@ -21,7 +21,7 @@ import re
 import Image
 import cherrypy
 
-from mox import Mox
+from mox import Mox, IsA, Func
 from utils import assert_raises
 from os.path import join
 
@@ -115,3 +115,429 @@ def test_templates_render_html_raises_context_already_have_make_url():
                   {'make_url': "ss"},
                   exc_pattern=r'The key "make_url" is already in ' \
                   'template context as[:] %s' % re.escape(repr(template.make_url)))
+
+def test_templates_render_html_raises_context_already_have_image_info():
+    assert_raises(KeyError,
+                  template.render_html,
+                  'index.html',
+                  {'image_info': "ss"},
+                  exc_pattern=r'The key "image_info" is already in ' \
+                  'template context as[:] %s' % re.escape(repr(template.image_info)))
+
+def test_get_loader_creates_loader_only_once_per_directory():
+    mox = Mox()
+    mox.StubOutWithMock(template, 'TemplateLoader')
+
+    loader_mock = mox.CreateMockAnything()
+    template.TemplateLoader('/path/to/templates',
+                            auto_reload=True,
+                            max_cache_size=template.CACHE_SIZE). \
+                            AndReturn(loader_mock)
+
+    mox.ReplayAll()
+    template.clear_loaders()
+    try:
+        got1 = template.get_loader('/path/to/templates')
+        got2 = template.get_loader('/path/to/templates')
+        assert got1 is loader_mock, 'Expected %r, got %r' % (loader_mock, got1)
+        assert got2 is loader_mock, 'Expected %r, got %r' % (loader_mock, got2)
+        mox.VerifyAll()
+    finally:
+        template.clear_loaders()
+        mox.UnsetStubs()
+
+def test_get_loader_uses_configured_cache_size():
+    mox = Mox()
+    mox.StubOutWithMock(template, 'TemplateLoader')
+
+    template.TemplateLoader('/path/to/templates',
+                            auto_reload=True,
+                            max_cache_size=5). \
+                            AndReturn('should-be-a-loader')
+
+    cherrypy.config['template.cache_size'] = 5
+    mox.ReplayAll()
+    template.clear_loaders()
+    try:
+        got = template.get_loader('/path/to/templates')
+        assert got == 'should-be-a-loader', 'Expected a loader, got %r' % got
+        mox.VerifyAll()
+    finally:
+        del cherrypy.config['template.cache_size']
+        template.clear_loaders()
+        mox.UnsetStubs()
+
+def test_get_loader_has_one_loader_per_directory():
+    template.clear_loaders()
+    try:
+        got1 = template.get_loader('/path/to/templates1')
+        got2 = template.get_loader('/path/to/templates2')
+        assert got1 is not got2, 'Each directory should have its own loader'
+        assert got1.search_path == ['/path/to/templates1']
+        assert got2.search_path == ['/path/to/templates2']
+    finally:
+        template.clear_loaders()
+
+def test_get_loader_has_one_loader_per_auto_reload_mode():
+    template.clear_loaders()
+    try:
+        got1 = template.get_loader('/path/to/templates', auto_reload=True)
+        got2 = template.get_loader('/path/to/templates', auto_reload=False)
+        assert got1 is not got2, 'Each auto_reload mode should have its own loader'
+        assert got1.auto_reload is True
+        assert got2.auto_reload is False
+    finally:
+        template.clear_loaders()
+
+def test_render_html_takes_auto_reload_from_config():
+    mox = Mox()
+    mox.StubOutWithMock(template, 'get_loader')
+
+    loader_mock = mox.CreateMockAnything()
+    template_mock = mox.CreateMockAnything()
+    generator_mock = mox.CreateMockAnything()
+
+    template.get_loader('/path/to/templates', False).AndReturn(loader_mock)
+    loader_mock.load('index.html').AndReturn(template_mock)
+    template_mock.generate(make_url=Func(callable),
+                           url_for=template.url_for,
+                           image_info=template.image_info,
+                           cache=IsA(template.FragmentCache)). \
+                          AndReturn(generator_mock)
+    generator_mock.render('html', doctype='html').AndReturn('should-be-html')
+
+    cherrypy.config['template.auto_reload'] = False
+    mox.ReplayAll()
+    try:
+        got = template.render_html('index.html', {},
+                                   template_path='/path/to/templates')
+        assert got == 'should-be-html', 'Expected rendered html, got %r' % got
+        mox.VerifyAll()
+    finally:
+        del cherrypy.config['template.auto_reload']
+        mox.UnsetStubs()
+
+def test_template_has_function_stream_html():
+    assert hasattr(template, 'stream_html'), 'sponge.template should have the function stream_html'
+    assert callable(template.stream_html), 'sponge.template.stream_html should be callable'
+
+def test_templates_stream_html_raises_filename_nonstring():
+    assert_raises(TypeError,
+                  template.stream_html,
+                  None,
+                  {},
+                  exc_pattern=r'sponge.template.stream_html ' \
+                  'takes a string as filename param, got None.')
+
+def test_templates_stream_html_raises_context_nondict():
+    assert_raises(TypeError,
+                  template.stream_html,
+                  'index.html',
+                  5,
+                  exc_pattern=r'sponge.template.stream_html ' \
+                  'takes a dict as context param, got 5.')
+
+def test_stream_html_turns_response_stream_on():
+    mox = Mox()
+    mox.StubOutWithMock(template, 'get_loader')
+
+    loader_mock = mox.CreateMockAnything()
+    template_mock = mox.CreateMockAnything()
+    generator_mock = mox.CreateMockAnything()
+
+    template.get_loader('/path/to/templates', True).AndReturn(loader_mock)
+    loader_mock.load('index.html').AndReturn(template_mock)
+    template_mock.generate(make_url=Func(callable),
+                           url_for=template.url_for,
+                           image_info=template.image_info,
+                           cache=IsA(template.FragmentCache)). \
+                          AndReturn(generator_mock)
+    generator_mock.serialize('html', doctype='html'). \
+                             AndReturn(iter([u'<p>', u'ol\xe1', u'</p>']))
+
+    cherrypy.response.stream = False
+    mox.ReplayAll()
+    try:
+        got = template.stream_html('index.html', {},
+                                   template_path='/path/to/templates')
+        assert cherrypy.response.stream is True, 'The response should be streamed'
+        chunks = list(got)
+        assert chunks == ['<p>ol\xc3\xa1</p>'], 'Expected one encoded chunk, got %r' % chunks
+        mox.VerifyAll()
+    finally:
+        cherrypy.response.stream = False
+        mox.UnsetStubs()
+
+def test_render_html_with_cache_key_renders_only_once():
+    mox = Mox()
+    mox.StubOutWithMock(template, 'get_loader')
+
+    loader_mock = mox.CreateMockAnything()
+    template_mock = mox.CreateMockAnything()
+    generator_mock = mox.CreateMockAnything()
+
+    template.get_loader('/path/to/templates', True).AndReturn(loader_mock)
+    loader_mock.load('index.html').AndReturn(template_mock)
+    template_mock.generate(make_url=Func(callable),
+                           url_for=template.url_for,
+                           image_info=template.image_info,
+                           cache=IsA(template.FragmentCache), page=1). \
+                          AndReturn(generator_mock)
+    generator_mock.render('html', doctype='html').AndReturn('should-be-html')
+
+    cherrypy.request.base = 'http://my.unit.test'
+    mox.ReplayAll()
+    template.invalidate_html()
+    try:
+        key = lambda context: context['page']
+        got1 = template.render_html('index.html', {'page': 1},
+                                    template_path='/path/to/templates',
+                                    cache_key=key)
+        got2 = template.render_html('index.html', {'page': 1},
+                                    template_path='/path/to/templates',
+                                    cache_key=key)
+        assert got1 == 'should-be-html', 'Expected rendered html, got %r' % got1
+        assert got2 == 'should-be-html', 'Expected cached html, got %r' % got2
+        mox.VerifyAll()
+    finally:
+        template.invalidate_html()
+        mox.UnsetStubs()
+
+def test_invalidate_html():
+    template.invalidate_html()
+    cache = template.output_cache
+    cache.set(('/templates', 'index.html', 'http://base', 1), 'index-1')
+    cache.set(('/templates', 'index.html', 'http://base', 2), 'index-2')
+    cache.set(('/templates', 'about.html', 'http://base', 1), 'about-1')
+    cache.set(('/templates', 'contact.html', 'http://base', 1), 'contact-1')
+
+    assert template.invalidate_html('index.html', 2) == 1
+    assert template.invalidate_html('index.html') == 1
+    assert template.invalidate_html(key=1) == 2
+    assert len(cache) == 0, 'Expected an empty cache, got %r items' % len(cache)
+
+def test_templates_render_html_raises_context_already_have_cache():
+    assert_raises(KeyError,
+                  template.render_html,
+                  'index.html',
+                  {'cache': "ss"},
+                  exc_pattern=r'The key "cache" is already in ' \
+                  'template context as[:] .*sponge.template.FragmentCache')
+
+def test_fragment_cache_calls_function_only_once():
+    calls = []
+    def sidebar(items):
+        calls.append(items)
+        return '<ul><li>%s</li></ul>' % items
+
+    cherrypy.request.base = 'http://my.unit.test'
+    template.invalidate_fragment()
+    try:
+        cache = template.FragmentCache('/path/to/templates')
+        got1 = cache('sidebar', 60, sidebar, items='foo')
+        got2 = cache('sidebar', 60, sidebar, items='bar')
+
+        assert got1 == '<ul><li>foo</li></ul>', 'Unexpected fragment %r' % got1
+        assert got2 == '<ul><li>foo</li></ul>', 'Unexpected fragment %r' % got2
+        assert isinstance(got1, template.Markup), 'Expected Markup, got %r' % got1
+        assert calls == ['foo'], 'The function should be called once, got %r' % calls
+    finally:
+        template.invalidate_fragment()
+
+def test_invalidate_fragment():
+    template.invalidate_fragment()
+    cache = template.fragment_cache
+    cache.set(('/templates', 'http://base', 'sidebar'), 'sidebar')
+    cache.set(('/templates', 'http://base', 'menu'), 'menu')
+    cache.set(('/templates', 'http://base', 'footer'), 'footer')
+
+    assert template.invalidate_fragment('sidebar') == 1
+    assert template.invalidate_fragment() == 2
+    assert len(cache) == 0, 'Expected an empty cache, got %r items' % len(cache)
+
+def test_bind_make_url_computes_base_once():
+    cherrypy.request.base = 'http://my.unit.test/for/ma-cherie/'
+    make_url = template.bind_make_url()
+
+    cherrypy.request.base = 'http://should.not.be.used'
+    got_url = make_url('/index')
+    expected_url = 'http://my.unit.test/for/ma-cherie/index'
+    assert got_url == expected_url, 'Expected %s, got %s' % (expected_url, got_url)
+
+def test_bound_make_url_takes_string_as_param():
+    cherrypy.request.base = 'http://my.unit.test'
+    assert_raises(TypeError, template.bind_make_url(), None,
+                  exc_pattern=r'sponge.template.make_url ' \
+                  'takes a string as param, got None.')
+
+def test_url_for():
+    template.routes_index['edit_photo'] = [(False, ''), (False, 'photo'),
+                                           (True, 'id'), (False, 'edit')]
+    cherrypy.request.base = 'http://my.unit.test'
+    try:
+        got_url = template.url_for('edit_photo', id=10)
+        expected_url = 'http://my.unit.test/photo/10/edit'
+        assert got_url == expected_url, 'Expected %s, got %s' % (expected_url, got_url)
+
+        got_url = template.url_for('edit_photo', id=u'a b', size='small')
+        expected_url = 'http://my.unit.test/photo/a%20b/edit?size=small'
+        assert got_url == expected_url, 'Expected %s, got %s' % (expected_url, got_url)
+    finally:
+        del template.routes_index['edit_photo']
+
+def test_url_for_unknown_route():
+    assert_raises(LookupError, template.url_for, 'not_a_route',
+                  exc_pattern=r'sponge.template.url_for could not ' \
+                  'find a route named \'not_a_route\'.')
+
+def test_url_for_missing_param():
+    template.routes_index['edit_photo'] = [(False, ''), (False, 'photo'),
+                                           (True, 'id'), (False, 'edit')]
+    try:
+        assert_raises(TypeError, template.url_for, 'edit_photo',
+                      exc_pattern=r'sponge.template.url_for needs the ' \
+                      'param \'id\' to build the route \'edit_photo\'.')
+    finally:
+        del template.routes_index['edit_photo']
+
+def test_templates_render_html_raises_context_already_have_url_for():
+    assert_raises(KeyError,
+                  template.render_html,
+                  'index.html',
+                  {'url_for': "ss"},
+                  exc_pattern=r'The key "url_for" is already in ' \
+                  'template context as[:] %s' % re.escape(repr(template.url_for)))
+
+def test_render_html_with_etag():
+    mox = Mox()
+    mox.StubOutWithMock(template, '_generate')
+
+    generator_mock = mox.CreateMockAnything()
+    template._generate('index.html', IsA(dict), '/path/to/templates'). \
+                       AndReturn(generator_mock)
+    generator_mock.render('html', doctype='html').AndReturn('should-be-html')
+
+    mox.StubOutWithMock(template.cptools, 'validate_etags')
+    template.cptools.validate_etags()
+
+    mox.ReplayAll()
+    try:
+        got = template.render_html('index.html', {},
+                                   template_path='/path/to/templates',
+                                   etag=True)
+        assert got == 'should-be-html', 'Expected rendered html, got %r' % got
+
+        expected = '"%s"' % template.md5('should-be-html').hexdigest()
+        etag = cherrypy.response.headers['ETag']
+        assert etag == expected, 'Expected ETag %s, got %s' % (expected, etag)
+        mox.VerifyAll()
+    finally:
+        del cherrypy.response.headers['ETag']
+        mox.UnsetStubs()
+
+def test_render_html_with_etag_not_modified():
+    etag = template.md5('should-be-html').hexdigest()
+    template.invalidate_html()
+    key = lambda context: 'key'
+    template.output_cache.set(('/path/to/templates', 'index.html',
+                               'http://my.unit.test', 'key'),
+                              {'html': 'should-be-html', 'etag': etag})
+
+    cherrypy.request.base = 'http://my.unit.test'
+    cherrypy.request.method = 'GET'
+    cherrypy.request.headers['If-None-Match'] = '"%s"' % etag
+    cherrypy.response.status = 200
+    try:
+        template.render_html('index.html', {},
+                             template_path='/path/to/templates',
+                             cache_key=key, etag=True)
+        assert False, 'render_html should redirect to 304 Not Modified'
+    except cherrypy.HTTPRedirect, e:
+        assert e.status == 304, 'Expected status 304, got %r' % e.status
+    finally:
+        del cherrypy.request.headers['If-None-Match']
+        del cherrypy.response.headers['ETag']
+        del cherrypy.response.ETag
+        cherrypy.response.status = None
+        template.invalidate_html()
+
+def test_accepts_gzip():
+    try:
+        cherrypy.request.headers['Accept-Encoding'] = 'gzip, deflate'
+        assert template.accepts_gzip() is True
+        cherrypy.request.headers['Accept-Encoding'] = 'deflate, gzip;q=0'
+        assert template.accepts_gzip() is False
+        cherrypy.request.headers['Accept-Encoding'] = 'identity'
+        assert template.accepts_gzip() is False
+        del cherrypy.request.headers['Accept-Encoding']
+        assert template.accepts_gzip() is False
+    finally:
+        cherrypy.request.headers.pop('Accept-Encoding', None)
+
+def test_compress():
+    import gzip
+    from StringIO import StringIO
+
+    got = template.compress('<html>some html</html>')
+    data = gzip.GzipFile(fileobj=StringIO(got)).read()
+    assert data == '<html>some html</html>', 'Unexpected uncompressed data %r' % data
+
+def test_render_html_gzipped_compresses_cached_page_only_once():
+    mox = Mox()
+    mox.StubOutWithMock(template, 'compress')
+    template.compress('should-be-html').AndReturn('should-be-gzipped-html')
+
+    template.invalidate_html()
+    key = lambda context: 'key'
+    template.output_cache.set(('/path/to/templates', 'index.html',
+                               'http://my.unit.test', 'key'),
+                              {'html': 'should-be-html'})
+
+    cherrypy.request.base = 'http://my.unit.test'
+    cherrypy.request.headers['Accept-Encoding'] = 'gzip'
+    mox.ReplayAll()
+    try:
+        for i in range(2):
+            got = template.render_html('index.html', {},
+                                       template_path='/path/to/templates',
+                                       cache_key=key, gzipped=True)
+            assert got == 'should-be-gzipped-html', 'Expected gzipped html, got %r' % got
+
+        headers = cherrypy.response.headers
+        assert headers['Content-Encoding'] == 'gzip'
+        assert headers['Vary'] == 'Accept-Encoding'
+        mox.VerifyAll()
+    finally:
+        del cherrypy.request.headers['Accept-Encoding']
+        del cherrypy.response.headers['Content-Encoding']
+        del cherrypy.response.headers['Vary']
+        template.invalidate_html()
+        mox.UnsetStubs()
+
+def test_render_html_gzipped_sends_plain_html_when_not_accepted():
+    template.invalidate_html()
+    key = lambda context: 'key'
+    template.output_cache.set(('/path/to/templates', 'index.html',
+                               'http://my.unit.test', 'key'),
+                              {'html': 'should-be-html'})
+
+    cherrypy.request.base = 'http://my.unit.test'
+    try:
+        got = template.render_html('index.html', {},
+                                   template_path='/path/to/templates',
+                                   cache_key=key, gzipped=True)
+        assert got == 'should-be-html', 'Expected plain html, got %r' % got
+        assert 'Content-Encoding' not in cherrypy.response.headers
+        assert cherrypy.response.headers['Vary'] == 'Accept-Encoding'
+    finally:
+        del cherrypy.response.headers['Vary']
+        template.invalidate_html()
+
+def test_join_chunks_gathers_small_chunks():
+    stream = [u'ab', u'cd', u'ef', u'\xe1', u'g']
+    got = list(template.join_chunks(iter(stream), size=4))
+    assert got == ['abcd', 'ef\xc3\xa1g'], 'Expected two encoded chunks, got %r' % got
+
+def test_join_chunks_with_empty_stream():
+    got = list(template.join_chunks(iter([])))
+    assert got == [], 'Expected no chunks, got %r' % got